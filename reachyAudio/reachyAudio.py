@@ -1,14 +1,44 @@
 """The reachyAudio module defines the ReachyAudio class."""
 
 import time
+import asyncio
+import weakref
+import functools
 from math import cos, sin, radians
+from threading import RLock, Thread
+from concurrent.futures import ThreadPoolExecutor
 
 from .reachyAudioPlayerRecorder import ReachyAudioPlayerRecorder
 from .reachyAudioTextToSpeech import ReachyAudioTextToSpeech
 from .reachyAudioMicArrayFeatures import ReachyAudioMicArrayFeatures
+from .reachyAudioMicArrayFeatures import POLLING_PERIOD
 from .reachyAudioAnswering import ReachyAudioAnswering
 from .reachyAudioSpeechRecognition import ReachyAudioSpeechRecognition
-from .reachyAudioSpeechRecognition import speechRecognitionCallback
+from .reachyAudioRecognizerBackends import createRecognizerBackend
+
+
+# Maximum time to wait for the angle of a sentence once it is recognized, in
+# seconds. The recording thread needs 1 second of silence to detect the end
+# of a speech, while the recognizer may end a sentence before
+ANGLE_WAIT_TIME = 1.0
+
+# Time during which the recognition stays paused after Reachy spoke, in
+# seconds, such that the end of his own speech is not recognized
+POST_SPEECH_DELAY = 2
+
+
+# Attributes created by the methods of each subsystem (listed by the
+# lazyAttributes of its class). Accessing one of them initializes the
+# corresponding subsystem if it is not initialized yet.
+LAZY_SUBSYSTEMS = tuple((subsystem, subsystem.lazyAttributes)
+                        for subsystem in (ReachyAudioTextToSpeech,
+                                          ReachyAudioSpeechRecognition,
+                                          ReachyAudioMicArrayFeatures,
+                                          ReachyAudioAnswering))
+
+# Subsystem owning each of these attributes
+LAZY_ATTRIBUTES = {name: subsystem for subsystem, attributes in LAZY_SUBSYSTEMS
+                   for name in attributes}
 
 
 class ReachyAudio(ReachyAudioPlayerRecorder,
@@ -22,30 +52,193 @@ class ReachyAudio(ReachyAudioPlayerRecorder,
     language processing.
     """
 
-    def __init__(self):
-        """Call the constructor of each submodule."""
+    def __init__(self, lazy=False, recognizerBackend=None,
+                 samplePeriod=POLLING_PERIOD):
+        """Call the constructor of each submodule.
+
+        :param lazy: If the submodules (except the player and recorder) should
+                     only be initialized the first time they are used. The
+                     method warmup allows to initialize them in parallel.
+        :param recognizerBackend: Name of the backend converting speech into
+                                  text (see ReachyAudioSpeechRecognition).
+        :param samplePeriod: Time between two measures of the microphone
+                             array, in seconds (see
+                             ReachyAudioMicArrayFeatures).
+        """
         ReachyAudioPlayerRecorder.__init__(self)
-        ReachyAudioTextToSpeech.__init__(self)
-        ReachyAudioSpeechRecognition.__init__(self)
-        ReachyAudioMicArrayFeatures.__init__(self)
-        ReachyAudioAnswering.__init__(self)
+
+        # Parameters given to the constructor of each submodule
+        self.subsystemParameters = {
+            ReachyAudioSpeechRecognition: {
+                'recognizerBackend': recognizerBackend},
+            ReachyAudioMicArrayFeatures: {'samplePeriod': samplePeriod},
+        }
+
+        self.subsystemLocks = {subsystem: RLock()
+                               for subsystem, _ in LAZY_SUBSYSTEMS}
+        self.initializingSubsystems = set()
+        self.initializedSubsystems = set()
+
+        if not lazy:
+            self.warmup(parallel=False)
+
+    def __getattr__(self, name):
+        """Initialize the submodule owning an attribute which is missing.
+
+        Only called when the attribute is not found, i.e. when the submodule
+        owning it has not been initialized yet.
+        """
+        if self.initializeOwner(name) and name in self.__dict__:
+            return self.__dict__[name]
+
+        raise AttributeError("'{}' object has no attribute '{}'".format(
+            type(self).__name__, name))
+
+    def __setattr__(self, name, value):
+        """Initialize the submodule owning an attribute before setting it.
+
+        Otherwise, the value would be overwritten when the submodule is
+        initialized (ex: the backend given to setRecognizerBackend).
+        """
+        self.initializeOwner(name)
+        object.__setattr__(self, name, value)
+
+    def initializeOwner(self, name):
+        """Initialize the submodule owning an attribute if it is not yet.
+
+        :param name: Name of the attribute.
+        :return: True if the submodule has been initialized by this call or
+                 is being initialized, False if the attribute is not owned
+                 by a submodule or if its submodule was already initialized.
+        """
+        initializedSubsystems = self.__dict__.get('initializedSubsystems')
+        subsystem = LAZY_ATTRIBUTES.get(name)
+
+        if initializedSubsystems is None or subsystem is None or \
+                subsystem in initializedSubsystems:
+            return False
+
+        self.initializeSubsystem(subsystem)
+        return True
 
     def __del__(self):
-        """Delete the text to speech engine."""
-        self.engine.stop()
+        """Release the resources of the submodules."""
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def close(self):
+        """Release the resources of the initialized submodules.
+
+        Stop the text to speech engine and the threads of the submodules,
+        release the microphone array and close the audio streams. The object
+        can not be used anymore afterwards.
+        """
+        if self.__dict__.get('engine') is not None:
+            self.engine.stop()
+            self.engine = None
+
+        for executor in ('speechExecutor', 'inference_executor'):
+            if self.__dict__.get(executor) is not None:
+                self.__dict__[executor].shutdown(wait=False)
+                setattr(self, executor, None)
+
+        if 'mic' in self.__dict__:
+            self.closeMicArray()
+
+        if 'audioContext' in self.__dict__:
+            self.closeAudio()
+
+    def initializeSubsystem(self, subsystem):
+        """Initialize a submodule if it is not initialized yet.
+
+        :param subsystem: Class of the submodule (ex: ReachyAudioAnswering).
+        """
+        with self.subsystemLocks[subsystem]:
+            # The submodule may already be initialized by another thread, or
+            # be accessing one of its own attributes during its initialization
+            if subsystem in self.initializedSubsystems or \
+                    subsystem in self.initializingSubsystems:
+                return
+
+            self.initializingSubsystems.add(subsystem)
+            try:
+                subsystem.__init__(self,
+                                   **self.subsystemParameters.get(subsystem,
+                                                                  {}))
+
+                if subsystem is ReachyAudioTextToSpeech:
+                    # The text to speech engine plays the altered voice with
+                    # the player of this object, such that the audio streams
+                    # kept open are shared. A weak reference avoids a cycle
+                    # delaying the cleanup of the object to the next garbage
+                    # collection
+                    self.reachyAudioPlayerRecorderObject.closeAudio()
+                    self.reachyAudioPlayerRecorderObject = weakref.proxy(self)
+
+                self.initializedSubsystems.add(subsystem)
+            finally:
+                self.initializingSubsystems.discard(subsystem)
+
+    def setRecognizerBackend(self, name, **parameters):
+        """Change the backend converting speech into text.
+
+        If the speech recognition is not initialized yet, the backend is only
+        given to it when it is, such that the default backend (and its
+        microphone) is not initialized for nothing.
+
+        :param name: Name of the backend (google, sphinx, vosk or fake), or an
+                     instance of RecognizerBackend.
+        :param parameters: Parameters of the backend (ex: modelDirectory for
+                           vosk, sentences or fixtureFileName for fake).
+        """
+        subsystem = ReachyAudioSpeechRecognition
+
+        with self.subsystemLocks[subsystem]:
+            if subsystem not in self.initializedSubsystems and \
+                    subsystem not in self.initializingSubsystems:
+                self.subsystemParameters[subsystem]['recognizerBackend'] = \
+                    createRecognizerBackend(name, **parameters)
+                return
+
+        subsystem.setRecognizerBackend(self, name, **parameters)
+
+    def warmup(self, parallel=True):
+        """Initialize all the submodules which are not initialized yet.
 
-    def conversation(self, reachyObject, alteredVoice=False):
+        :param parallel: If the submodules should be initialized at the same
+                         time in different threads (for example, the answering
+                         model is loaded while the recognizer is calibrated).
+        """
+        subsystems = [subsystem for subsystem, _ in LAZY_SUBSYSTEMS]
+
+        if not parallel:
+            for subsystem in subsystems:
+                self.initializeSubsystem(subsystem)
+            return
+
+        with ThreadPoolExecutor(max_workers=len(subsystems)) as executor:
+            futures = [executor.submit(self.initializeSubsystem, subsystem)
+                       for subsystem in subsystems]
+            for future in futures:
+                future.result()
+
+    def conversation(self, reachyObject, alteredVoice=False,
+                     pipelined=False):
         """Allow Reachy to converse with people.
 
         :param reachyObject: Instance of the Reachy class.
         :param alteredVoice: If we want Reachy's voice to sound more
                              robotic like.
+        :param pipelined: If the answer should be computed and its speech
+                          rendered while Reachy's head turns toward the
+                          interlocutor, such that Reachy speaks as soon as
+                          the motion ends.
         """
-        # Allow to store the detected angle as the recognition thread
-        # takes more time to detect the end of a voice sample than the
-        # recording thread
-        stored_angle = -1
-
         # Use the LEDs to make the conversation more interactive
         self.pixel_ring.set_brightness(0x12)
         self.pixel_ring.set_color_palette(self.COLORS['ORANGE'],
@@ -54,19 +247,23 @@ class ReachyAudio(ReachyAudioPlayerRecorder,
 
         # Initialize the recognition thread so that we can do both recognition
         # and orientation detection
-        stop_listening = self.recognizer.listen_in_background(
-                                                    self.microphone,
-                                                    speechRecognitionCallback)
+        stop_listening = self.listenInBackground()
         print("Listening...")
 
+        # Last detected angle, used if no angle is detected for a sentence
+        stored_angle = -1
+
         while True:
             try:
-                # Try to detect if someone spoke
-                said = self.getDetectedSentence()
-                angle = self.getDetectedAngle()
-                if angle != -1:
-                    stored_angle = angle
+                # Wait until someone spoke. The timeout only allows to handle
+                # a keyboard interrupt regularly
+                said = self.waitForDetectedSentence(timeout=1)
                 if said != "":
+                    # The angle of the sentence may be published after the
+                    # sentence, keep the previous one if it is not
+                    angle = self.waitForDetectedAngle(timeout=ANGLE_WAIT_TIME)
+                    if angle != -1:
+                        stored_angle = angle
 
                     # Reachy heard and recognized a sentence, he will now
                     # answer to it. We set that the robot is speaking such that
@@ -84,13 +281,21 @@ class ReachyAudio(ReachyAudioPlayerRecorder,
                     # Move the head toward the interlocutor
                     theta = radians(stored_angle)
                     reachyObject.head.compliant = False
-                    reachyObject.head.look_at(2, cos(theta), sin(theta)-0.3,
-                                              duration=2, wait=True)
+                    motion = Thread(target=reachyObject.head.look_at,
+                                    args=(2, cos(theta), sin(theta)-0.3),
+                                    kwargs={'duration': 2, 'wait': True})
+                    motion.start()
+
+                    if not pipelined:
+                        motion.join()
 
                     # Answer to the interlocutor
                     tag, answer = self.answer(said)
-                    self.speak(answer, alteredVoice=alteredVoice)
-                    time.sleep(2)
+                    if pipelined:
+                        self.speakAfterMotion(answer, motion, alteredVoice)
+                    else:
+                        self.speak(answer, alteredVoice=alteredVoice)
+                    time.sleep(POST_SPEECH_DELAY)
 
                     # End of the conversation depending on the sentence intent
                     if tag == "goodbye":
@@ -108,8 +313,6 @@ class ReachyAudio(ReachyAudioPlayerRecorder,
                                                       self.COLORS['YELLOW'])
                     print("Listening...")
 
-                time.sleep(0.1)
-
             # End of the conversation if keyboard interrupt
             except KeyboardInterrupt:
                 break
@@ -123,3 +326,118 @@ class ReachyAudio(ReachyAudioPlayerRecorder,
         self.pixel_ring.set_color_palette(self.COLORS['ORANGE'],
                                           self.COLORS['YELLOW'])
         print("End of conversation !")
+
+    def speakAfterMotion(self, text, motion, alteredVoice=False):
+        """Render a speech during a motion and play it once it is finished.
+
+        :param text: Text to be said.
+        :param motion: Thread running the motion.
+        :param alteredVoice: If we want Reachy's voice to sound more
+                             robotic like.
+        """
+        try:
+            speech = self.renderSpeech(text, alteredVoice)
+        except Exception as e:
+            # The rendering of the speech failed, say it without rendering it
+            # first
+            print("Exception: " + str(e))
+            speech = None
+
+        motion.join()
+
+        if speech is not None:
+            self.playSpeech(speech, alteredVoice)
+        else:
+            self.speak(text, alteredVoice=alteredVoice)
+
+    async def conversationAsync(self, reachyObject, alteredVoice=False):
+        """Coroutine allowing Reachy to converse with people.
+
+        Same conversation as the method conversation, but the blocking parts
+        run in other threads: Reachy's head turns toward the interlocutor and
+        the LEDs change color while the answer is computed and said.
+
+        :param reachyObject: Instance of the Reachy class.
+        :param alteredVoice: If we want Reachy's voice to sound more
+                             robotic like.
+        """
+        loop = asyncio.get_running_loop()
+
+        def runInThread(function, *args, **kwargs):
+            return loop.run_in_executor(None, functools.partial(
+                function, *args, **kwargs))
+
+        # Use the LEDs to make the conversation more interactive
+        await runInThread(self.pixel_ring.set_brightness, 0x12)
+        await runInThread(self.pixel_ring.set_color_palette,
+                          self.COLORS['ORANGE'], self.COLORS['YELLOW'])
+        await runInThread(self.pixel_ring.speak)
+
+        # Initialize the recognition thread so that we can do both recognition
+        # and orientation detection
+        stop_listening = self.listenInBackground()
+        print("Listening...")
+
+        # Last detected angle, used if no angle is detected for a sentence
+        stored_angle = -1
+
+        try:
+            while True:
+                said = await self.waitForDetectedSentenceAsync(timeout=1)
+                if said == "":
+                    continue
+
+                # Reachy heard and recognized a sentence, he will now answer
+                # to it. We set that the robot is speaking such that we don't
+                # try to recognize what he will say
+                angle = await runInThread(self.waitForDetectedAngle,
+                                          ANGLE_WAIT_TIME)
+                if angle != -1:
+                    stored_angle = angle
+                self.setRobotSpeaking()
+                self.setRobotSpeakingMic()
+                print("Reachy heared a voice at ", stored_angle, "degrees.")
+                print("Reachy thinks you said: ", said)
+
+                # Change the LEDs color and move the head toward the
+                # interlocutor while the answer is computed and said
+                theta = radians(stored_angle)
+                reachyObject.head.compliant = False
+                motion = asyncio.gather(
+                    runInThread(self.pixel_ring.set_color_palette,
+                                self.COLORS['MAGENTA'], self.COLORS['CYAN']),
+                    runInThread(reachyObject.head.look_at, 2, cos(theta),
+                                sin(theta)-0.3, duration=2, wait=True))
+
+                try:
+                    tag, answer = await self.answer_async(said)
+                    await self.speakAsync(answer, alteredVoice=alteredVoice)
+                finally:
+                    await motion
+
+                await asyncio.sleep(POST_SPEECH_DELAY)
+
+                # End of the conversation depending on the sentence intent
+                if tag == "goodbye":
+                    break
+
+                # Reachy stoped to speak, we reactivate the recording thread
+                # and the recognition thread
+                self.clearDetectedSentence()
+                self.clearDetectedAngle()
+                self.clearRobotSpeakingMic()
+                self.clearRobotSpeaking()
+                await runInThread(self.pixel_ring.set_color_palette,
+                                  self.COLORS['ORANGE'], self.COLORS['YELLOW'])
+                print("Listening...")
+
+        finally:
+            # End of the conversation, we stop the recognition thread
+            await runInThread(stop_listening, wait_for_stop=True)
+            self.clearDetectedSentence()
+            self.clearDetectedAngle()
+            self.clearRobotSpeakingMic()
+            self.clearRobotSpeaking()
+            self.pixel_ring.set_color_palette(self.COLORS['ORANGE'],
+                                              self.COLORS['YELLOW'])
+            print("End of conversation !")
@@ -1,15 +1,348 @@
 """This module defines the ReachyAudioAnswering class."""
 
-import nltk
+import copy
 import json
-import torch
+import time
 import random
-import pickle
-from nltk.stem.lancaster import LancasterStemmer
+import asyncio
+import hashlib
+import threading
+import multiprocessing
+import numpy as np
+from threading import Lock, local
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from .reachyAudioLazyImport import lazyImport
+
+# torch and nltk are only imported when the answering model is used
+nltk = lazyImport("nltk")
+torch = lazyImport("torch")
+lancaster = lazyImport("nltk.stem.lancaster")
+
+stemmer = None
 
-stemmer = LancasterStemmer()
 CONFIDENCE_THRESHOLD = 0.7
 
+# Maximum number of stems and of sentence encodings kept in memory
+STEM_MEMO_SIZE = 100000
+SENTENCE_CACHE_SIZE = 10000
+
+# Number of patterns from which the preprocessing is done by several processes
+PARALLEL_PREPROCESSING_THRESHOLD = 2000
+INTENTS_FILE = "utils/intents.json"
+ARTIFACTS_FILE = "utils/data.npz"
+MODEL_FILE = "utils/model.pth"
+DEFAULT_ANSWER = "I didn't get that, can you try again ?"
+
+
+class LRUCache():
+    """LRUCache class.
+
+    Mapping of bounded size which evicts its least recently used entries. It
+    also counts the number of lookups which found (hits) or did not find
+    (misses) their key.
+    """
+
+    def __init__(self, maxsize):
+        """Initialize an empty cache.
+
+        :param maxsize: Maximum number of entries.
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def __len__(self):
+        """Return the number of entries."""
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """Return the value of a key and mark it as recently used.
+
+        :param key: The key to look up.
+        :param default: Value returned if the key is not in the cache.
+        :return: The value of the key.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """Add an entry, evicting the least recently used one if needed.
+
+        :param key: The key of the entry.
+        :param value: The value of the entry.
+        """
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def update(self, items):
+        """Add several entries.
+
+        :param items: Iterable of (key, value) pairs.
+        """
+        for key, value in items:
+            self.put(key, value)
+
+    def items(self):
+        """Return a copy of the entries.
+
+        :return: List of (key, value) pairs, from the least recently used.
+        """
+        with self.lock:
+            return list(self.entries.items())
+
+    def clear(self):
+        """Remove all the entries and reset the counters."""
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """Return the statistics of the cache.
+
+        :return: Dictionary of the hits, misses, current and maximum size.
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self.entries), "maxsize": self.maxsize}
+
+
+# Stems already computed, the stemming of a word never changes
+stem_memo = LRUCache(STEM_MEMO_SIZE)
+
+
+def stem(word):
+    """Apply word stemming i.e. find the root of the word.
+
+    :param word: The word to be stemmed.
+    :return: The stemmed word.
+    """
+    global stemmer
+
+    stemmed = stem_memo.get(word)
+
+    if stemmed is None:
+        if stemmer is None:
+            stemmer = lancaster.LancasterStemmer()
+        stemmed = stemmer.stem(word)
+        stem_memo.put(word, stemmed)
+
+    return stemmed
+
+
+def preprocess_patterns(patterns):
+    """Tokenize and stem patterns, in a preprocessing process.
+
+    :param patterns: The patterns to be preprocessed.
+    :return: The tokens and the stemmed lowercase tokens of each pattern.
+    :return: The stems of the words of the patterns.
+    """
+    results = []
+    stems = {}
+    for pattern in patterns:
+        tokens = nltk.word_tokenize(pattern)
+        for w in tokens:
+            w = w.lower()
+            if w not in stems:
+                stems[w] = stem(w)
+        results.append((tokens, [stems[w.lower()] for w in tokens]))
+
+    return results, list(stems.items())
+
+
+def preprocess_corpus(data, processes=None):
+    """Compute the vocabulary, the intents and the training set of a corpus.
+
+    The patterns are tokenized and stemmed by a pool of processes, each of
+    them working on a contiguous part of the patterns. The stems computed by
+    the processes are then added to the stems of this process. As forking a
+    process copies the locks held by its other threads, the pool is only
+    used when no other thread is running (ex: not during a parallel
+    ReachyAudio.warmup).
+
+    :param data: Content of the json file containing the training data.
+    :param processes: Number of processes, the patterns are preprocessed
+                      in this process if 1 or if other threads are running.
+                      By default, several processes are only used for large
+                      corpora.
+    :return: The vocabulary, the intents, the training inputs and the
+             expected outputs.
+    """
+    patterns = [pattern for intent in data["intents"]
+                for pattern in intent["patterns"]]
+    tags = [intent["tag"] for intent in data["intents"]
+            for _ in intent["patterns"]]
+
+    if processes is None:
+        processes = multiprocessing.cpu_count() \
+            if len(patterns) >= PARALLEL_PREPROCESSING_THRESHOLD else 1
+
+    # Tokenize and stem the patterns
+    if processes > 1 and threading.active_count() == 1:
+        size = -(-len(patterns) // processes)
+        with multiprocessing.Pool(processes) as pool:
+            parts = pool.map(preprocess_patterns,
+                             [patterns[i:i + size]
+                              for i in range(0, len(patterns), size)])
+        results = []
+        for part_results, part_memo in parts:
+            results.extend(part_results)
+            stem_memo.update(part_memo)
+    else:
+        results, _ = preprocess_patterns(patterns)
+
+    # Build the vocabulary (without the question marks) and the intents
+    words = sorted({stemmed for tokens, stems in results
+                    for w, stemmed in zip(tokens, stems) if w != "?"})
+    labels = sorted(set(tags))
+
+    word_index = {w: i for i, w in enumerate(words)}
+    label_index = {l: i for i, l in enumerate(labels)}
+
+    # Transform each pattern into a bag of words (an input for the
+    # network) and compute the corresponding expected output
+    train_input = np.zeros((len(patterns), len(words)), dtype=np.float32)
+    train_target = np.zeros((len(patterns), len(labels)), dtype=np.float32)
+    for x, ((_, stems), tag) in enumerate(zip(results, tags)):
+        train_input[x, [word_index[w] for w in stems if w in word_index]] = 1
+        train_target[x, label_index[tag]] = 1
+
+    return words, labels, train_input, train_target
+
+
+def load_artifacts(path, source_hash):
+    """Load the training data computed from the json file.
+
+    :param path: Path of the .npz file containing the training data.
+    :param source_hash: Hash of the current content of the json file.
+    :return: The vocabulary, the intents, the training inputs and the
+             expected outputs (None if the file does not exist or was
+             computed from another json file).
+    """
+    try:
+        with np.load(path) as artifacts:
+            if str(artifacts["source_hash"]) != source_hash:
+                return None
+
+            return (artifacts["words"].tolist(),
+                    artifacts["labels"].tolist(),
+                    artifacts["train_input"],
+                    artifacts["train_target"])
+    except Exception:
+        return None
+
+
+def save_artifacts(path, source_hash, words, labels, train_input,
+                   train_target):
+    """Save the training data computed from the json file.
+
+    The arrays are stored uncompressed such that they are loaded without
+    any processing.
+
+    :param path: Path of the .npz file containing the training data.
+    :param source_hash: Hash of the content of the json file.
+    :param words: The vocabulary.
+    :param labels: The intents.
+    :param train_input: The inputs of the training set.
+    :param train_target: The expected outputs of the training set.
+    """
+    np.savez(path, source_hash=np.array(source_hash),
+             words=np.array(words, dtype=str),
+             labels=np.array(labels, dtype=str),
+             train_input=train_input, train_target=train_target)
+
+
+def inference_mode():
+    """Return a context in which the model is evaluated without autograd.
+
+    torch.inference_mode is used when available (PyTorch >= 1.9), the older
+    torch.no_grad otherwise.
+    """
+    return getattr(torch, "inference_mode", torch.no_grad)()
+
+
+class NumpyIntentModel():
+    """NumpyIntentModel class.
+
+    Pure NumPy version of the network model used to answer. As the model
+    only contains linear layers followed by a softmax, all the linear layers
+    are merged into a single matrix product.
+    """
+
+    def __init__(self, weight, bias):
+        """Initialize the merged linear layer.
+
+        :param weight: Weight matrix of the merged linear layers.
+        :param bias: Bias vector of the merged linear layers.
+        """
+        self.weight = weight
+        self.bias = bias
+
+    @classmethod
+    def from_sequential(cls, model):
+        """Merge the layers of a torch Sequential model.
+
+        :param model: Sequential model made of linear layers and ending with
+                      a softmax.
+        :return: Instance of the NumpyIntentModel class.
+        """
+        weight = None
+        bias = None
+
+        for layer in model:
+            if isinstance(layer, torch.nn.Linear):
+                layer_weight = layer.weight.detach().numpy().astype(np.float64)
+                layer_bias = layer.bias.detach().numpy().astype(np.float64)
+                if weight is None:
+                    weight, bias = layer_weight, layer_bias
+                else:
+                    weight = layer_weight @ weight
+                    bias = layer_weight @ bias + layer_bias
+            elif not isinstance(layer, torch.nn.Softmax):
+                raise ValueError("Unsupported layer: {}".format(layer))
+
+        return cls(weight.astype(np.float32), bias.astype(np.float32))
+
+    @classmethod
+    def load(cls, path):
+        """Load a model saved by the save method.
+
+        :param path: Path of the .npz file.
+        :return: Instance of the NumpyIntentModel class.
+        """
+        with np.load(path) as arrays:
+            return cls(arrays["weight"], arrays["bias"])
+
+    def save(self, path):
+        """Save the model in a .npz file.
+
+        :param path: Path of the .npz file.
+        """
+        np.savez(path, weight=self.weight, bias=self.bias)
+
+    def __call__(self, bag):
+        """Compute the output of the model.
+
+        :param bag: Bag of words (a vector or a matrix of bags of words).
+        :return: The probability of each intent.
+        """
+        logits = bag @ self.weight.T + self.bias
+        exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+
+        return exp / exp.sum(axis=-1, keepdims=True)
+
 
 class ReachyAudioAnswering():
     """ReachyAudioAnswering class.
@@ -21,96 +354,166 @@ class ReachyAudioAnswering():
     close to the training sentences however.
     """
 
+    # Attributes set by the methods of this class, to be updated when one is
+    # added. ReachyAudio initializes this class when one of them is used
+    lazyAttributes = ('data', 'inference_buffers', 'inference_executor',
+                      'inference_model', 'label_index', 'labels', 'model',
+                      'responses', 'sentence_cache', 'word_index', 'words')
+
     def __init__(self):
         """Train the model of the network or load it if it already exists."""
         print("Initializing Reachy answering model...")
 
-        # Load the json file containing the training data
-        with open("utils/intents.json") as myFile:
-            self.data = json.load(myFile)
+        # Load the json file containing the training data, its hash
+        # identifies the training data and the model computed from it
+        with open(INTENTS_FILE, "rb") as myFile:
+            content = myFile.read()
+        self.data = json.loads(content)
+        source_hash = hashlib.sha256(content).hexdigest()
 
         # Load the data necessary to the initialization
-        # of the network if the training has already been
-        # done before, create it otherwise
+        # of the network if it has already been computed
+        # from the same json file, create it otherwise
+        artifacts = load_artifacts(ARTIFACTS_FILE, source_hash)
+        if artifacts is not None:
+            self.words, self.labels, train_input, train_target = artifacts
+            self.build_indices()
+        else:
+            train_input, train_target = self.build_training_set()
+
+            # We store the computed training set for future uses
+            save_artifacts(ARTIFACTS_FILE, source_hash, self.words,
+                           self.labels, train_input, train_target)
+
+        # Load the model if it has already been trained
+        # on the same training data, train it otherwise
+        self.model = self.build_model(train_input.shape[1],
+                                      train_target.shape[1])
         try:
-            with open("utils/data.pickle", "rb") as f:
-                self.words, self.labels,
-                train_input, train_target = pickle.load(f)
-        except:
-            # Contain all the different stemmed words constituing the patterns
-            self.words = []
+            checkpoint = torch.load(MODEL_FILE)
+            if checkpoint["source_hash"] != source_hash:
+                raise ValueError("the model was trained on other data")
+            self.model.load_state_dict(checkpoint["state_dict"])
+        except Exception:
+            self.train_model_early_stopping(torch.from_numpy(train_input),
+                                            torch.from_numpy(train_target))
+            torch.save({"source_hash": source_hash,
+                        "state_dict": self.model.state_dict()}, MODEL_FILE)
 
-            # Contain all the different intents of the input sentences
-            self.labels = []
+        # Responses of each intent
+        self.responses = {tg["tag"]: tg["responses"]
+                          for tg in self.data["intents"]}
 
-            # Contain the training sentences of the network
-            docs_x = []
+        self.prepare_inference()
 
-            # Contain the corresponding intent of a tokenized pattern
-            docs_y = []
+        # Thread in which the asynchronous answers are computed
+        self.inference_executor = ThreadPoolExecutor(max_workers=1)
 
-            # Contain the training inputs of the network
-            train_input = []
+        print("Done")
 
-            # Contain the expected output for the training of the network
-            train_target = []
+    def build_training_set(self, processes=None):
+        """Compute the vocabulary, the intents and the training set.
 
-            # Extract the data from the json file
-            for intent in self.data["intents"]:
-                for pattern in intent["patterns"]:
-                    wrds = nltk.word_tokenize(pattern)
-                    self.words.extend(wrds)
-                    docs_x.append(pattern)
-                    docs_y.append(intent["tag"])
+        The patterns of the json file are tokenized and stemmed to build the
+        vocabulary, then each of them is transformed into a bag of words.
 
-                if intent["tag"] not in self.labels:
-                    self.labels.append(intent["tag"])
+        :param processes: Number of processes preprocessing the patterns
+                          (see preprocess_corpus).
+        :return: The inputs and the expected outputs of the training set.
+        """
+        self.words, self.labels, train_input, train_target = \
+            preprocess_corpus(self.data, processes)
 
-            # Apply word stemming i.e. find the root of the word
-            # (ex: happened -> happen)
-            self.words = [stemmer.stem(w.lower()) for w in self.words
-                          if w != "?"]
+        self.build_indices()
 
-            # transform to set to remove doublons
-            self.words = sorted(list(set(self.words)))
+        return train_input, train_target
 
-            self.labels = sorted(self.labels)
+    def build_model(self, input_size, output_size):
+        """Create the model of the network.
 
-            out_empty = [0 for _ in range(len(self.labels))]
+        :param input_size: Size of the vocabulary.
+        :param output_size: Number of intents.
+        :return: The untrained model.
+        """
+        return torch.nn.Sequential(
+            torch.nn.Linear(input_size, 8),
+            torch.nn.Linear(8, 8),
+            torch.nn.Linear(8, output_size),
+            torch.nn.Softmax(dim=-1))
+
+    def prepare_inference(self, backend="torch"):
+        """Prepare the model to answer as fast as possible.
+
+        A frozen copy of the model (no gradient is computed for its
+        parameters) is used, which can be converted to TorchScript or to pure
+        NumPy. The model itself can still be trained afterwards, this method
+        has then to be called again.
+
+        :param backend: "torch" to answer with the model itself, "torchscript"
+                        to answer with its frozen TorchScript version or
+                        "numpy" to answer with its NumPy version.
+        """
+        if backend == "torch":
+            self.inference_model = self.frozen_model()
+        elif backend == "torchscript":
+            self.inference_model = torch.jit.freeze(
+                torch.jit.trace(self.frozen_model(),
+                                torch.zeros(len(self.words))))
+        elif backend == "numpy":
+            self.inference_model = NumpyIntentModel.from_sequential(self.model)
+        else:
+            raise ValueError("Unknown inference backend: {}".format(backend))
+
+        # Input buffers of the model, one per thread answering
+        self.inference_buffers = local()
+
+    def inference_input(self):
+        """Return the input buffer of the model for the current thread.
+
+        Each thread has its own buffer, such that several threads can answer
+        at the same time.
+
+        :return: Tensor (or NumPy array for the numpy backend) of the size of
+                 the vocabulary.
+        """
+        buffers = self.inference_buffers
+        if getattr(buffers, "model", None) is not self.inference_model:
+            if isinstance(self.inference_model, NumpyIntentModel):
+                buffers.input = np.zeros(len(self.words), dtype=np.float32)
+            else:
+                buffers.input = torch.zeros(len(self.words))
+            buffers.indices = []
+            buffers.model = self.inference_model
 
-            # Transform each training sentence into a bag of words (an input
-            # for the network) and compute the corresponding expected output
-            for x, doc in enumerate(docs_x):
-                bag = self.bag_of_words(doc)
+        return buffers.input
 
-                # Expected output
-                output_row = out_empty[:]
-                output_row[self.labels.index(docs_y[x])] = 1
+    def frozen_model(self):
+        """Copy the model for inference only.
 
-                # We add the input and the expected output to the training set
-                train_input.append(bag)
-                train_target.append(output_row)
+        :return: Copy of the model in evaluation mode, whose parameters do not
+                 require gradients.
+        """
+        model = copy.deepcopy(self.model).eval()
+        for parameter in model.parameters():
+            parameter.requires_grad_(False)
 
-            # We store the computed training set for future uses
-            with open("utils/data.pickle", "wb") as f:
-                pickle.dump((self.words, self.labels,
-                             train_input, train_target), f)
+        return model
 
-        # Load the model if it already exists, train it otherwise
-        try:
-            self.model = torch.load('utils/model.pth')
-        except:
-            self.model = torch.nn.Sequential(
-                torch.nn.Linear(len(train_input[0]), 8),
-                torch.nn.Linear(8, 8),
-                torch.nn.Linear(8, len(train_target[0])),
-                torch.nn.Softmax(dim=-1))
-
-            self.train_model(torch.Tensor(train_input),
-                             torch.Tensor(train_target))
-            torch.save(self.model, 'utils/model.pth')
+    def export_model(self, path, backend="torchscript"):
+        """Export the model for inference.
 
-        print("Done")
+        :param path: Path of the exported model.
+        :param backend: "torchscript" to save it as a TorchScript module or
+                        "numpy" to save it as a .npz file which can be loaded
+                        by NumpyIntentModel.load.
+        """
+        if backend == "torchscript":
+            torch.jit.trace(self.frozen_model(),
+                            torch.zeros(len(self.words))).save(path)
+        elif backend == "numpy":
+            NumpyIntentModel.from_sequential(self.model).save(path)
+        else:
+            raise ValueError("Unknown export backend: {}".format(backend))
 
     def train_model(self, train_input, train_target, nb_epochs=500,
                     show_metric=False):
@@ -153,6 +556,129 @@ class ReachyAudioAnswering():
                         e, self.compute_nb_errors(train_input, train_target) /
                         train_input.size(0) * 100))
 
+    def train_model_early_stopping(self, train_input, train_target,
+                                   batch_size=32, max_epochs=500,
+                                   patience=20, validation_split=0.2,
+                                   learning_rate=0.01, show_metric=False):
+        """Train the model of the network with mini-batches and early stopping.
+
+        The model is trained with the cross-entropy of its logits (the output
+        of the model before the softmax). A part of the sentences of each
+        intent is held out, and the training stops when the loss on them has
+        not improved for patience epochs. The model is then trained again on
+        the whole training set for the number of epochs of the best loss,
+        such that the held-out sentences are learned too. When no sentence
+        can be held out (intents with too few sentences), the loss on the
+        whole training set is monitored and the best parameters are kept.
+
+        :param train_input: The inputs of the training set.
+        :param train_target: The corresponding outputs of the training set.
+        :param batch_size: The number of sentences used for each update of
+                           the parameters.
+        :param max_epochs: The maximum number of times that the learning
+                           algorithm will work through the training dataset.
+        :param patience: The number of epochs without improvement after which
+                         the training stops.
+        :param validation_split: The part of the training set held out to
+                                 monitor the training.
+        :param learning_rate: The learning rate of the optimizer.
+        :param show_metric: Allow to show the performance of the model during
+                            his training.
+        :return: Dictionary of the wall time of the training, the number of
+                 epochs done, the epoch at which the model converged and the
+                 number of epochs done on the whole training set.
+        """
+        start_time = time.perf_counter()
+
+        # Split the sentences of each intent, such that every intent keeps
+        # most of its sentences for the training
+        train_classes = torch.argmax(train_target, 1)
+        fit_indices = []
+        monitor_indices = []
+        for intent in range(train_target.size(1)):
+            indices = torch.nonzero(train_classes == intent).flatten()
+            indices = indices[torch.randperm(indices.size(0))]
+            nb_validation = int(indices.size(0) * validation_split)
+            monitor_indices.append(indices[:nb_validation])
+            fit_indices.append(indices[nb_validation:])
+        fit_indices = torch.cat(fit_indices)
+        monitor_indices = torch.cat(monitor_indices)
+        held_out = monitor_indices.size(0) > 0
+        if not held_out:
+            monitor_indices = fit_indices
+
+        fit_input = train_input[fit_indices]
+        fit_classes = train_classes[fit_indices]
+        monitor_input = train_input[monitor_indices]
+        monitor_classes = train_classes[monitor_indices]
+
+        # The model without its softmax layer outputs the logits
+        logits_model = self.model[:-1]
+        criterion = torch.nn.CrossEntropyLoss()
+        optimizer = torch.optim.Adam(self.model.parameters(),
+                                     lr=learning_rate)
+
+        def train_epoch(epoch_input, epoch_classes):
+            # Go through the sentences by mini-batches in a random order
+            order = torch.randperm(epoch_input.size(0))
+            for start in range(0, epoch_input.size(0), batch_size):
+                batch = order[start:start + batch_size]
+                loss = criterion(logits_model(epoch_input[batch]),
+                                 epoch_classes[batch])
+
+                self.model.zero_grad()
+                loss.backward()
+                optimizer.step()
+
+        best_loss = float("inf")
+        best_epoch = 0
+        best_state = None
+
+        for e in range(max_epochs):
+            train_epoch(fit_input, fit_classes)
+
+            # Keep the parameters of the best epoch
+            with torch.no_grad():
+                monitor_loss = criterion(logits_model(monitor_input),
+                                         monitor_classes).item()
+
+            if show_metric:
+                print("Epoch {} -> Monitored loss = {:.04f}".format(
+                    e, monitor_loss))
+
+            if monitor_loss < best_loss:
+                best_loss = monitor_loss
+                best_epoch = e
+                best_state = {name: value.clone() for name, value
+                              in self.model.state_dict().items()}
+            elif e - best_epoch >= patience:
+                break
+
+        refit_epochs = 0
+        if held_out:
+            # Train a new model on the whole training set for as many epochs
+            # as the best model
+            for layer in self.model:
+                if hasattr(layer, "reset_parameters"):
+                    layer.reset_parameters()
+            optimizer = torch.optim.Adam(self.model.parameters(),
+                                         lr=learning_rate)
+            refit_epochs = best_epoch + 1
+            for _ in range(refit_epochs):
+                train_epoch(train_input, train_classes)
+        else:
+            self.model.load_state_dict(best_state)
+
+        metrics = {"wall_time": time.perf_counter() - start_time,
+                   "epochs": e + 1,
+                   "convergence_epoch": best_epoch + 1,
+                   "refit_epochs": refit_epochs}
+        print("Model trained in {:.2f} s, {} epochs (converged at epoch {})"
+              .format(metrics["wall_time"], metrics["epochs"],
+                      metrics["convergence_epoch"]))
+
+        return metrics
+
     def compute_nb_errors(self, data_input, data_target):
         """Compute the number of classification errors of our network's model.
 
@@ -160,8 +686,6 @@ class ReachyAudioAnswering():
         :param data_target: The corresponding outputs of the testing set.
         :return: The number of classification errors made on the testing set.
         """
-        nb_data_errors = 0
-
         # Compute the output of the model
         output = self.model(data_input)
 
@@ -170,12 +694,86 @@ class ReachyAudioAnswering():
         expected_classes = torch.argmax(data_target, 1)
 
         # Compare the prediction of the model with the ground truth
-        for predicted_classe, expected_classe in zip(predicted_classes,
-                                                     expected_classes):
-            if predicted_classe != expected_classe:
-                nb_data_errors = nb_data_errors + 1
+        return int((predicted_classes != expected_classes).sum())
 
-        return nb_data_errors
+    def build_indices(self):
+        """Build the lookup tables of the vocabulary and of the intents.
+
+        Allow to find the position of a stemmed word in the bag of words, or
+        of an intent in the output of the network, without scanning the
+        vocabulary or the intents.
+        """
+        self.word_index = {w: i for i, w in enumerate(self.words)}
+        self.label_index = {l: i for i, l in enumerate(self.labels)}
+
+        # Positions in the vocabulary of the words of the last sentences
+        self.sentence_cache = LRUCache(SENTENCE_CACHE_SIZE)
+
+    def cache_info(self):
+        """Return the statistics of the caches used to encode sentences.
+
+        :return: Dictionary of the statistics of the stem cache and of the
+                 sentence cache (see LRUCache.info).
+        """
+        return {"stem": stem_memo.info(),
+                "sentence": self.sentence_cache.info()}
+
+    def bag_of_words_indices(self, input_sentence):
+        """Compute the positions of the words of a sentence in the vocabulary.
+
+        :param input_sentence: The sentence to be answered.
+        :return: The sorted positions of the words of the sentence which are
+                 in the vocabulary.
+        """
+        # Sentences which only differ by their case or their spaces have the
+        # same bag of words
+        normalized_sentence = " ".join(input_sentence.lower().split())
+        indices = self.sentence_cache.get(normalized_sentence)
+
+        if indices is None:
+            # Tokenize the input sentence and apply word stemming
+            # on each of the tokenized words
+            sentence_words = nltk.word_tokenize(normalized_sentence)
+            stemmed_words = [stem(word) for word in sentence_words]
+
+            indices = sorted({self.word_index[w] for w in stemmed_words
+                              if w in self.word_index})
+            self.sentence_cache.put(normalized_sentence, indices)
+
+        return list(indices)
+
+    def vectorize(self, input_sentence, out=None, set_indices=None):
+        """Compute the bag of words of a sentence as a tensor.
+
+        Only the positions of the words of the sentence are set, such that
+        the cost depends on the length of the sentence and not on the size of
+        the vocabulary.
+
+        :param input_sentence: The sentence to be answered.
+        :param out: Preallocated tensor (or NumPy array) of the size of the
+                    vocabulary in which the bag of words is written, a new
+                    tensor is created if None.
+        :param set_indices: List of the positions of out set by the previous
+                            call, only these positions are reset instead of
+                            the whole vocabulary. It is updated with the
+                            positions set by this call.
+        :return: The bag of words corresponding to the input sentence.
+        """
+        if out is None:
+            out = torch.zeros(len(self.words))
+        elif set_indices is None:
+            out[:] = 0
+        elif set_indices:
+            out[set_indices] = 0
+
+        indices = self.bag_of_words_indices(input_sentence)
+        if indices:
+            out[indices] = 1
+
+        if set_indices is not None:
+            set_indices[:] = indices
+
+        return out
 
     def bag_of_words(self, input_sentence):
         """Compute a bag of words that will be used as input for the network.
@@ -189,19 +787,11 @@ class ReachyAudioAnswering():
         :param input_sentence: The sentence to be answered.
         :return: The bag of word corresponding to the input sentence.
         """
-        bag = []
-
-        # Tokenize the input sentence and apply word stemming
-        # on each of the tokenized words
-        sentence_words = nltk.word_tokenize(input_sentence)
-        stemmed_words = [stemmer.stem(word.lower()) for word in sentence_words]
+        bag = [0] * len(self.words)
 
         # Fill the vector
-        for w in self.words:
-            if w in stemmed_words:
-                bag.append(1)
-            else:
-                bag.append(0)
+        for i in self.bag_of_words_indices(input_sentence):
+            bag[i] = 1
 
         return bag
 
@@ -214,21 +804,85 @@ class ReachyAudioAnswering():
         :return: The answer to the input sentence.
         """
         # Compute the output of the model with respect to the input sentence
-        results = self.model(torch.Tensor(self.bag_of_words(input_sentence)))
+        inference_input = self.inference_input()
+        with inference_mode():
+            results = self.inference_model(
+                self.vectorize(input_sentence, inference_input,
+                               self.inference_buffers.indices))
 
         # Take the most confident output as the result
-        results_index = torch.argmax(results)
+        results_index = int(results.argmax())
         intent = self.labels[results_index]
 
         # Provide an answer only if the network
         # was confident enough about his output
         if results[results_index] > CONFIDENCE_THRESHOLD:
-            for tg in self.data["intents"]:
-                if tg["tag"] == intent:
-                    # The response is picked randomly among the ones
-                    # related to the detected input sentence intent
-                    responses = tg["responses"]
-                    answer = random.choice(responses)
-                    return intent, answer
-
-        return None, "I didn't get that, can you try again ?"
+            answer = self.pick_response(intent)
+            if answer is not None:
+                return intent, answer
+
+        return None, DEFAULT_ANSWER
+
+    async def answer_async(self, input_sentence):
+        """Coroutine answering to a question without blocking the event loop.
+
+        The answers are computed one at a time in a dedicated thread.
+
+        :param input_sentence: The sentence to be answered.
+        :return: The detected intent and the answer (see the method answer).
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.inference_executor,
+                                          self.answer, input_sentence)
+
+    def pick_response(self, intent):
+        """Pick randomly one of the responses related to an intent.
+
+        :param intent: The detected intent.
+        :return: A response to the intent (None if the intent is unknown).
+        """
+        if intent not in self.responses:
+            return None
+
+        return random.choice(self.responses[intent])
+
+    def answer_batch(self, input_sentences):
+        """Answer to several sentences at once.
+
+        All the sentences are encoded in a single matrix such that the model
+        is evaluated only once for all of them.
+
+        :param input_sentences: The sentences to be answered.
+        :return: The detected intents of the input sentences (None if the
+                 intent could not be detected).
+        :return: The confidence of the model in each of the intents.
+        :return: The answers to the input sentences.
+        """
+        # Encode the sentences as the rows of a bag of words matrix
+        batch = torch.zeros(len(input_sentences), len(self.words))
+        for row, input_sentence in enumerate(input_sentences):
+            indices = self.bag_of_words_indices(input_sentence)
+            if indices:
+                batch[row, indices] = 1
+
+        # Compute the output of the model for all the sentences at once
+        with inference_mode():
+            confidences, results_indices = torch.max(self.model(batch), 1)
+
+        intents = []
+        answers = []
+        for confidence, results_index in zip(confidences.tolist(),
+                                             results_indices.tolist()):
+            intent = self.labels[results_index]
+            answer = None
+            if confidence > CONFIDENCE_THRESHOLD:
+                answer = self.pick_response(intent)
+
+            if answer is None:
+                intents.append(None)
+                answers.append(DEFAULT_ANSWER)
+            else:
+                intents.append(intent)
+                answers.append(answer)
+
+        return intents, confidences.tolist(), answers
@@ -0,0 +1,40 @@
+"""This module defines the lazyImport function.
+
+The libraries used by some parts of ReachyAudio (torch, nltk, pyttsx3,
+SpeechRecognition...) are slow to import. They are imported lazily such that
+only the parts of the library which are actually used pay for their imports.
+"""
+
+import importlib
+
+
+class LazyModule():
+    """LazyModule class.
+
+    Stand-in for a module which is only imported on the first access to one
+    of its attributes.
+    """
+
+    def __init__(self, name):
+        """Store the name of the module to import.
+
+        :param name: Absolute name of the module (ex: "scipy.io.wavfile").
+        """
+        self.__dict__['name'] = name
+        self.__dict__['module'] = None
+
+    def __getattr__(self, attribute):
+        """Import the module if needed and return one of its attributes."""
+        if self.__dict__['module'] is None:
+            self.__dict__['module'] = importlib.import_module(self.name)
+
+        return getattr(self.__dict__['module'], attribute)
+
+
+def lazyImport(name):
+    """Return a module which will only be imported when it is first used.
+
+    :param name: Absolute name of the module (ex: "scipy.io.wavfile").
+    :return: Instance of the LazyModule class.
+    """
+    return LazyModule(name)
@@ -14,88 +14,410 @@
 """
 
 import time
+import queue
 import usb.core
 import numpy as np
-from threading import Thread
+from collections import namedtuple
+from threading import Thread, Lock, Event
 from math import cos, sin, radians
 from utils.tuning import Tuning
 from utils.pixel_ring import PixelRing
+from .reachyAudioStateChannel import StateChannel
 
-detectedAngle = -1.0
-robotSpeakingMic = False
+# Number of measures kept by the orientation callback (30 seconds of measures
+# taken every 50 milliseconds)
+ORIENTATION_BUFFER_SIZE = 600
 
+# Time between two measures of the mic array poller, in seconds
+POLLING_PERIOD = 0.05
 
-def orientationCallback(mic):
+# Timeout of the USB transfers of the mic array poller, in milliseconds
+POLLING_TIMEOUT = 200
+
+# Measures of the mic array taken at the same time
+MicArraySnapshot = namedtuple('MicArraySnapshot',
+                              ['timestamp', 'voiceActivity', 'angle'])
+
+# Pollers shared by the objects using the same mic array, with the number of
+# objects using each of them
+sharedPollers = {}
+sharedPollersLock = Lock()
+
+
+class MicArrayPoller():
+    """MicArrayPoller class.
+
+    Thread measuring the voice activity and the direction of arrival angle
+    of the mic array at a fixed period. Each measure is published as a
+    timestamped snapshot to all the subscribers, such that the number of USB
+    transfers does not depend on the number of features using the measures.
+    """
+
+    def __init__(self, mic, period=POLLING_PERIOD, timeout=POLLING_TIMEOUT):
+        """Initialize the poller, the method start starts the polling.
+
+        :param mic: Instance of the Tuning class.
+        :param period: Time between two measures, in seconds.
+        :param timeout: Timeout of the USB transfers, in milliseconds, such
+                        that a device which does not answer does not block
+                        the polling.
+        """
+        self.mic = Tuning(mic.dev, timeout)
+        self.period = period
+        self.latest = None
+        self.subscribers = []
+        self.lock = Lock()
+        self.stopEvent = Event()
+        self.thread = None
+
+    def start(self):
+        """Start polling the mic array in a background thread."""
+        if self.isRunning():
+            return
+
+        self.stopEvent.clear()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Ask the polling thread to stop, without waiting for it."""
+        self.stopEvent.set()
+
+    def join(self, timeout=None):
+        """Wait until the polling thread is stopped.
+
+        :param timeout: Maximum waiting time in seconds, None to wait
+                        indefinitely.
+        """
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def isRunning(self):
+        """Return if the polling thread is running.
+
+        :return: True if the thread is running, False otherwise.
+        """
+        return self.thread is not None and self.thread.is_alive()
+
+    def subscribe(self, maxsize=100):
+        """Receive the next snapshots.
+
+        :param maxsize: Maximum number of snapshots waiting in the queue, the
+                        oldest ones are dropped if the subscriber is too slow.
+        :return: Queue in which the snapshots are put.
+        """
+        snapshots = queue.Queue(maxsize)
+        with self.lock:
+            self.subscribers.append(snapshots)
+
+        return snapshots
+
+    def unsubscribe(self, snapshots):
+        """Stop receiving the snapshots.
+
+        :param snapshots: Queue returned by subscribe.
+        """
+        with self.lock:
+            if snapshots in self.subscribers:
+                self.subscribers.remove(snapshots)
+
+    def getLatest(self):
+        """Return the last snapshot.
+
+        :return: The last instance of MicArraySnapshot (None if no measure
+                 has been taken yet).
+        """
+        return self.latest
+
+    def publish(self, snapshot):
+        """Give a snapshot to all the subscribers.
+
+        :param snapshot: Instance of MicArraySnapshot.
+        """
+        self.latest = snapshot
+
+        with self.lock:
+            for snapshots in self.subscribers:
+                try:
+                    snapshots.put_nowait(snapshot)
+                except queue.Full:
+                    # Drop the oldest snapshot to keep the latest one
+                    try:
+                        snapshots.get_nowait()
+                    except queue.Empty:
+                        pass
+                    snapshots.put_nowait(snapshot)
+
+    def run(self):
+        """Measure the mic array periodically until the poller is stopped."""
+        while not self.stopEvent.is_set():
+            start = time.monotonic()
+
+            try:
+                self.publish(MicArraySnapshot(time.time(),
+                                              self.mic.is_voice(),
+                                              self.mic.direction))
+            except usb.core.USBError as e:
+                print("Exception: " + str(e))
+
+            self.stopEvent.wait(max(0.0, self.period -
+                                    (time.monotonic() - start)))
+
+
+def deviceKey(dev):
+    """Return a key identifying a USB device.
+
+    :param dev: Instance of the usb.core.Device class.
+    :return: The bus and the address of the device.
+    """
+    return getattr(dev, 'bus', None), getattr(dev, 'address', id(dev))
+
+
+def acquireMicArrayPoller(mic, period=POLLING_PERIOD):
+    """Return the running poller of a mic array, start it if needed.
+
+    The objects using the same mic array share the same poller, which is only
+    stopped once all of them have released it.
+
+    :param mic: Instance of the Tuning class.
+    :param period: Time between two measures, in seconds. Only used if the
+                   poller is not running yet.
+    :return: Instance of the MicArrayPoller class.
+    """
+    key = deviceKey(mic.dev)
+
+    with sharedPollersLock:
+        if key in sharedPollers:
+            poller, users = sharedPollers[key]
+        else:
+            poller, users = MicArrayPoller(mic, period), 0
+            poller.start()
+        sharedPollers[key] = (poller, users + 1)
+
+    return poller
+
+
+def releaseMicArrayPoller(poller, timeout=1.0):
+    """Release a poller returned by acquireMicArrayPoller.
+
+    The poller is stopped and its USB resources are released when it is not
+    used anymore.
+
+    :param poller: Instance of the MicArrayPoller class.
+    :param timeout: Maximum time in seconds to wait for the poller to stop.
+    """
+    key = deviceKey(poller.mic.dev)
+
+    with sharedPollersLock:
+        if key not in sharedPollers:
+            return
+        users = sharedPollers[key][1] - 1
+        if users > 0:
+            sharedPollers[key] = (poller, users)
+            return
+        del sharedPollers[key]
+
+    poller.stop()
+    poller.join(timeout)
+    poller.mic.close()
+
+
+def circularMean(angles):
+    """Compute the mean of angles, taking into account that 0° = 360°.
+
+    The mean of 350° and 10° is 0° and not 180°.
+
+    :param angles: Array of angles in degrees.
+    :return: The mean angle in degrees, between 0 and 360.
+    """
+    radiansAngles = np.radians(angles)
+    meanAngle = np.degrees(np.arctan2(np.mean(np.sin(radiansAngles)),
+                                      np.mean(np.cos(radiansAngles))))
+
+    # The second modulo handles the rounding of tiny negative angles to 360
+    return float(meanAngle % 360) % 360
+
+
+class OrientationBuffer():
+    """OrientationBuffer class.
+
+    Circular buffer of fixed capacity storing measures of voice activity and
+    of direction of arrival angle. When it is full, the oldest measures are
+    overwritten.
+    """
+
+    def __init__(self, capacity=ORIENTATION_BUFFER_SIZE):
+        """Allocate the buffer.
+
+        :param capacity: Maximum number of measures kept.
+        """
+        self.capacity = capacity
+        self.voices = np.zeros(capacity, dtype=bool)
+        self.angles = np.zeros(capacity)
+        self.clear()
+
+    def clear(self):
+        """Remove all the measures."""
+        self.start = 0
+        self.length = 0
+        self.voiceSamples = 0
+
+    def append(self, voiceActivity, angle):
+        """Add a measure.
+
+        :param voiceActivity: If voice activity was detected.
+        :param angle: Direction of arrival angle.
+        """
+        index = (self.start + self.length) % self.capacity
+
+        if self.length == self.capacity:
+            # Overwrite the oldest measure
+            self.voiceSamples -= int(self.voices[index])
+            self.start = (self.start + 1) % self.capacity
+        else:
+            self.length += 1
+
+        self.voices[index] = bool(voiceActivity)
+        self.angles[index] = angle
+        self.voiceSamples += int(bool(voiceActivity))
+
+    def averageAngle(self):
+        """Compute the direction of arrival of the last speech.
+
+        Do not take into acount the first half of the samples of voice
+        activity as the first measures of angle are othen strongly
+        correlated to the last angle detected.
+
+        :return: The circular mean of the angles measured during the second
+                 half of the voice activity.
+        """
+        order = (self.start + np.arange(self.length)) % self.capacity
+        voicedAngles = self.angles[order][self.voices[order]]
+
+        return circularMean(voicedAngles[self.voiceSamples // 2:])
+
+
+def orientationCallback(snapshots, angleChannel, robotSpeakingMic,
+                        period=POLLING_PERIOD):
     """Orientation callback function.
 
     Callback function performing the recording of the voice activity and the
     direction of arrival angle. Detects the end of a speech and average the
-    measures taken to update the direction of arrival angle.
-
-    :param mic: Instance of the Tuning class.
+    measures taken to publish the direction of arrival angle.
+
+    :param snapshots: Queue of the snapshots of the mic array, a None
+                      snapshot stops the callback.
+    :param angleChannel: Instance of the StateChannel class in which the
+                         detected angle is published.
+    :param robotSpeakingMic: Event set while the robot is speaking.
+    :param period: Time between two snapshots, in seconds.
     """
     counter = 0
-    voiceCounter = 1
-    angles = np.array([])
-    voices = np.array([])
-    global detectedAngle
-    global robotSpeakingMic
+    samples = OrientationBuffer(round(ORIENTATION_BUFFER_SIZE *
+                                      POLLING_PERIOD / period))
+    # Number of snapshots in 1 second
+    silence = max(1, round(1.0 / period))
 
     while True:
-        if not robotSpeakingMic:
-            detectedAngle = -1
-
-            # Record data
-            voiceActivity = mic.is_voice()
-            voices = np.append(voices, voiceActivity)
-            angles = np.append(angles, mic.direction)
-
-            if voiceActivity:
-                counter = 0
-            else:
-                counter += 1
-
-            voiceSamples = np.count_nonzero(voices)
-
-            # If voice activity has been previously detected and there is no
-            # voice activity anymore since 1 second then compute the
-            # average angle
-            if counter == 20 and voiceSamples > 2:
-                counter = 0
-                doNotConsider = voiceSamples // 2
-                voiceCounter = 1
-                detectedAngle = 0
-                numberDetections = 0
-                for voice, angle in zip(voices, angles):
-                    if voice:
-                        # Do not take into acount the first samples of
-                        # voice activity as the first measures of
-                        # angle are othen strongly correlated to the last
-                        # angle detected
-                        if voiceCounter > doNotConsider:
-                            detectedAngle += angle
-                            numberDetections += 1
-                        else:
-                            voiceCounter += 1
-
-                detectedAngle /= numberDetections
-                voices = np.array([])
-                angles = np.array([])
-
-            # if nobody speak during a long time, reset the array
-            # to avoid too high array lenght
-            elif counter > 20 and voiceSamples <= 5:
-                counter = 0
-                voices = np.array([])
-                angles = np.array([])
-
-            if detectedAngle != -1:
-                time.sleep(0.5)
-            else:
-                time.sleep(0.05)
+        snapshot = snapshots.get()
+        if snapshot is None:
+            break
 
+        # The measures taken while the robot speaks are not used
+        if robotSpeakingMic.is_set():
+            continue
+
+        # Record data
+        samples.append(snapshot.voiceActivity, snapshot.angle)
+
+        if snapshot.voiceActivity:
+            counter = 0
         else:
-            time.sleep(0.1)
+            counter += 1
+
+        # If voice activity has been previously detected and there is no
+        # voice activity anymore since 1 second then compute the
+        # average angle
+        if counter == silence and samples.voiceSamples > 2:
+            counter = 0
+            angleChannel.publish(samples.averageAngle())
+            samples.clear()
+
+        # if nobody speak during a long time, reset the buffer
+        elif counter > silence and samples.voiceSamples <= 5:
+            counter = 0
+            samples.clear()
+
+
+class OrientationSampler():
+    """OrientationSampler class.
+
+    Thread running the orientation callback on the snapshots of a mic array
+    poller. It can be started, stopped and joined such that the objects using
+    it can be closed without leaving a thread behind.
+    """
+
+    def __init__(self, poller, angleChannel, robotSpeakingMic):
+        """Initialize the sampler, the method start starts the sampling.
+
+        :param poller: Instance of the MicArrayPoller class.
+        :param angleChannel: Instance of the StateChannel class in which the
+                             detected angle is published.
+        :param robotSpeakingMic: Event set while the robot is speaking.
+        """
+        self.poller = poller
+        self.angleChannel = angleChannel
+        self.robotSpeakingMic = robotSpeakingMic
+        self.snapshots = None
+        self.thread = None
+
+    def start(self):
+        """Start the orientation callback in a background thread."""
+        if self.isRunning():
+            return
+
+        self.snapshots = self.poller.subscribe()
+        self.thread = Thread(target=orientationCallback,
+                             args=(self.snapshots, self.angleChannel,
+                                   self.robotSpeakingMic, self.poller.period),
+                             daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Ask the orientation callback to stop, without waiting for it."""
+        if self.snapshots is None:
+            return
+
+        self.poller.unsubscribe(self.snapshots)
+
+        # Wake up the callback with the snapshot stopping it
+        while True:
+            try:
+                self.snapshots.put_nowait(None)
+                break
+            except queue.Full:
+                try:
+                    self.snapshots.get_nowait()
+                except queue.Empty:
+                    pass
+
+        self.snapshots = None
+
+    def join(self, timeout=None):
+        """Wait until the orientation callback is stopped.
+
+        :param timeout: Maximum waiting time in seconds, None to wait
+                        indefinitely.
+        """
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def isRunning(self):
+        """Return if the orientation callback is running.
+
+        :return: True if the thread is running, False otherwise.
+        """
+        return self.thread is not None and self.thread.is_alive()
 
 
 class ReachyAudioMicArrayFeatures():
@@ -108,8 +430,19 @@ class ReachyAudioMicArrayFeatures():
     interlocutor.
     """
 
-    def __init__(self):
-        """Initialize the ReachyAudioMicArrayFeatures class."""
+    # Attributes set by the methods of this class, to be updated when one is
+    # added. ReachyAudio initializes this class when one of them is used
+    lazyAttributes = ('COLORS', 'angleChannel', 'mic', 'micPoller',
+                      'orientationSampler', 'pixel_ring', 'robotSpeakingMic')
+
+    def __init__(self, samplePeriod=POLLING_PERIOD):
+        """Initialize the ReachyAudioMicArrayFeatures class.
+
+        :param samplePeriod: Time between two measures of the voice activity
+                             and of the direction of arrival angle, in
+                             seconds. The objects using the same mic array
+                             share the measures of the first one created.
+        """
         # Initialize the mic object
         print("Mic object initialization...")
 
@@ -123,7 +456,11 @@ class ReachyAudioMicArrayFeatures():
         self.COLORS['ORANGE'] = 0xFF4F00
 
         self.mic = None
+        self.micPoller = None
+        self.orientationSampler = None
         self.pixel_ring = None
+        self.angleChannel = StateChannel(-1.0)
+        self.robotSpeakingMic = Event()
         dev = usb.core.find(idVendor=0x2886, idProduct=0x0018)
         if dev:
             self.mic = Tuning(dev)
@@ -140,11 +477,35 @@ class ReachyAudioMicArrayFeatures():
         # and voice orientation
         if self.mic is not None:
             print("Recording thread initialization...")
-            recordingThread = Thread(target=orientationCallback,
-                                     args=(self.mic,))
-            recordingThread.start()
+            self.micPoller = acquireMicArrayPoller(self.mic, samplePeriod)
+            self.orientationSampler = OrientationSampler(
+                self.micPoller, self.angleChannel, self.robotSpeakingMic)
+            self.orientationSampler.start()
             print("Done")
 
+    def closeMicArray(self, timeout=1.0):
+        """Stop the recording thread and release the microphone array.
+
+        :param timeout: Maximum time in seconds to wait for the threads to
+                        stop.
+        """
+        if self.orientationSampler is not None:
+            self.orientationSampler.stop()
+            self.orientationSampler.join(timeout)
+            self.orientationSampler = None
+
+        if self.micPoller is not None:
+            releaseMicArrayPoller(self.micPoller, timeout)
+            self.micPoller = None
+
+        if self.mic is not None:
+            self.mic.close()
+            self.mic = None
+
+        if self.pixel_ring is not None:
+            self.pixel_ring.close()
+            self.pixel_ring = None
+
     def longIsVoice(self, numberMeasures=40, timeDelay=0.1):
         """Allow to make several measurements of voice activity spaced in time.
 
@@ -160,7 +521,8 @@ class ReachyAudioMicArrayFeatures():
         if self.mic is not None:
             print("Start")
             for _ in range(numberMeasures):
-                sample = self.mic.is_voice()
+                snapshot = self.micPoller.getLatest()
+                sample = None if snapshot is None else snapshot.voiceActivity
                 recording.append(sample)
                 print(sample)
                 time.sleep(timeDelay)
@@ -185,7 +547,8 @@ class ReachyAudioMicArrayFeatures():
         if self.mic is not None:
             print("Start")
             for _ in range(numberMeasures):
-                sample = self.mic.direction
+                snapshot = self.micPoller.getLatest()
+                sample = None if snapshot is None else snapshot.angle
                 recording.append(sample)
                 print(sample)
                 time.sleep(timeDelay)
@@ -201,21 +564,28 @@ class ReachyAudioMicArrayFeatures():
         :return: Direction of arrival angle computed after the end of a speech
                  has been detected.
         """
-        global detectedAngle
-        return detectedAngle
+        return self.angleChannel.get()
+
+    def waitForDetectedAngle(self, timeout=None):
+        """Wait until the end of a speech is detected.
+
+        :param timeout: Maximum waiting time in seconds, None to wait
+                        indefinitely.
+        :return: The direction of arrival angle of the speech, or -1.0 if the
+                 timeout expired first.
+        """
+        return self.angleChannel.waitFor(timeout)
 
     def clearDetectedAngle(self):
         """Clear the last detected angle."""
-        global detectedAngle
-        detectedAngle = -1.0
+        self.angleChannel.clear()
 
     def setRobotSpeakingMic(self):
         """Set that the robot is currently speaking.
 
         Allow to not run the code in the recording thread.
         """
-        global robotSpeakingMic
-        robotSpeakingMic = True
+        self.robotSpeakingMic.set()
         self.mic.set_vad_threshold(1000)
 
     def clearRobotSpeakingMic(self):
@@ -223,8 +593,7 @@ class ReachyAudioMicArrayFeatures():
 
         Allow to run the code in the recording thread.
         """
-        global robotSpeakingMic
-        robotSpeakingMic = False
+        self.robotSpeakingMic.clear()
         self.mic.set_vad_threshold(15)
 
     def orientToInterlocutor(self, reachyObject):
@@ -234,16 +603,15 @@ class ReachyAudioMicArrayFeatures():
                              motors commands to move Reachy's head.
         """
         if self.mic is not None:
+            # Only orient toward a speech ending after this call
+            self.clearDetectedAngle()
             print("Listening...")
-            while True:
-                angle = self.getDetectedAngle()
-                if angle != -1.0:
-                    print("Heared a voice at ", angle, "degrees.")
-                    theta = radians(angle)
-                    reachyObject.head.compliant = False
-                    reachyObject.head.look_at(2, cos(theta), sin(theta)-0.3,
-                                              duration=2, wait=True)
-                    time.sleep(0.1)
-                    break
+            angle = self.waitForDetectedAngle()
+            print("Heared a voice at ", angle, "degrees.")
+            theta = radians(angle)
+            reachyObject.head.compliant = False
+            reachyObject.head.look_at(2, cos(theta), sin(theta)-0.3,
+                                      duration=2, wait=True)
+            time.sleep(0.1)
         else:
             print("mic is None")
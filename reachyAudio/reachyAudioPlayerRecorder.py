@@ -1,7 +1,360 @@
 """This module defines the ReachyAudioPlayerRecorder class."""
 
+import mmap
 import wave
+import struct
 import pyaudio
+import numpy as np
+from threading import Lock
+
+
+def bytesView(buffer):
+    """Return a read-only view of the bytes of an audio buffer without copy.
+
+    :param buffer: NumPy array or any object supporting the buffer protocol
+                   (bytes, memoryview, mmap...).
+    :return: Read-only memoryview of unsigned bytes.
+    """
+    if isinstance(buffer, np.ndarray):
+        # only copies the array if it is not already contiguous
+        buffer = np.ascontiguousarray(buffer).view()
+        buffer.flags.writeable = False
+
+    view = memoryview(buffer).cast('B')
+
+    # memoryview.toreadonly requires Python 3.8, a writable buffer (ex:
+    # bytearray) is made read-only through a NumPy array instead
+    if not view.readonly:
+        readOnlyArray = np.frombuffer(view, dtype=np.uint8)
+        readOnlyArray.flags.writeable = False
+        view = memoryview(readOnlyArray)
+
+    return view
+
+
+def findWavData(buffer):
+    """Find the audio samples in the content of a WAV file.
+
+    :param buffer: Content of the WAV file (bytes, memoryview, mmap...).
+    :return: Offset and size in bytes of the samples in the buffer.
+    """
+    if buffer[0:4] != b'RIFF' or buffer[8:12] != b'WAVE':
+        raise ValueError('not a WAV file')
+
+    # Go through the chunks of the file until the data chunk
+    offset = 12
+    while offset + 8 <= len(buffer):
+        chunkId = buffer[offset:offset + 4]
+        size = struct.unpack('<I', buffer[offset + 4:offset + 8])[0]
+        if chunkId == b'data':
+            return offset + 8, min(size, len(buffer) - offset - 8)
+
+        # chunks are aligned on two bytes
+        offset += 8 + size + (size & 1)
+
+    raise ValueError('no data chunk in the WAV file')
+
+
+class AudioContext():
+    """AudioContext class.
+
+    This class keeps a PyAudio object and its audio streams open between
+    several recordings and playbacks, such that the audio devices do not have
+    to be enumerated and opened again each time. The streams are identified
+    by their format, their number of channels and their rate.
+
+    It can be used as a context manager to close everything at the end.
+    """
+
+    def __init__(self):
+        """Initialize an empty context, PyAudio is started on first use."""
+        self.pyAudio = None
+        self.outputStreams = {}
+        self.inputStreams = {}
+        self.callbackStreams = []
+        self.lock = Lock()
+
+    def __enter__(self):
+        """Return the context itself."""
+        return self
+
+    def __exit__(self, *args):
+        """Close the context when leaving the with block."""
+        self.close()
+
+    def getPyAudio(self):
+        """Return the PyAudio object of the context, create it if needed.
+
+        :return: Instance of the PyAudio class.
+        """
+        with self.lock:
+            if self.pyAudio is None:
+                self.pyAudio = pyaudio.PyAudio()
+
+            return self.pyAudio
+
+    def getOutputStream(self, format, channels, rate):
+        """Return an opened output stream, open it if needed.
+
+        :param format: PyAudio format of the samples.
+        :param channels: Number of samples per frame.
+        :param rate: Number of frames per second.
+        :return: Started PyAudio output stream.
+        """
+        p = self.getPyAudio()
+        key = (format, channels, rate)
+
+        with self.lock:
+            stream = self.outputStreams.get(key)
+            if stream is None:
+                stream = p.open(format=format,
+                                channels=channels,
+                                rate=rate,
+                                output=True)
+                self.outputStreams[key] = stream
+            elif stream.is_stopped():
+                stream.start_stream()
+
+            return stream
+
+    def getInputStream(self, format, channels, rate, framesPerBuffer):
+        """Return an opened input stream, open it if needed.
+
+        :param format: PyAudio format of the samples.
+        :param channels: Number of samples per frame.
+        :param rate: Number of frames per second.
+        :param framesPerBuffer: Number of frames per buffer.
+        :return: Started PyAudio input stream.
+        """
+        p = self.getPyAudio()
+        key = (format, channels, rate)
+
+        with self.lock:
+            stream = self.inputStreams.get(key)
+            if stream is None:
+                stream = p.open(format=format,
+                                channels=channels,
+                                rate=rate,
+                                input=True,
+                                frames_per_buffer=framesPerBuffer)
+                self.inputStreams[key] = stream
+            elif stream.is_stopped():
+                stream.start_stream()
+
+            return stream
+
+    def openCallbackStream(self, format, channels, rate, framesPerBuffer,
+                           callback):
+        """Open an input stream calling a function for each recorded buffer.
+
+        Unlike the streams returned by getInputStream, these streams are not
+        shared. They are closed by closeStream, or by close with the others.
+
+        :param format: PyAudio format of the samples.
+        :param channels: Number of samples per frame.
+        :param rate: Number of frames per second.
+        :param framesPerBuffer: Number of frames per buffer.
+        :param callback: Function called by PyAudio with each buffer.
+        :return: Started PyAudio input stream.
+        """
+        p = self.getPyAudio()
+
+        with self.lock:
+            stream = p.open(format=format,
+                            channels=channels,
+                            rate=rate,
+                            input=True,
+                            frames_per_buffer=framesPerBuffer,
+                            stream_callback=callback)
+            self.callbackStreams.append(stream)
+
+        stream.start_stream()
+
+        return stream
+
+    def closeStream(self, stream):
+        """Close a stream of the context, even if it is already closed.
+
+        :param stream: Stream returned by one of the methods of the context.
+        """
+        with self.lock:
+            for streams in (self.outputStreams, self.inputStreams):
+                for key, value in list(streams.items()):
+                    if value is stream:
+                        del streams[key]
+            if stream in self.callbackStreams:
+                self.callbackStreams.remove(stream)
+
+        try:
+            stream.stop_stream()
+            stream.close()
+        except Exception:
+            # The stream was already closed
+            pass
+
+    def pauseInputStream(self, stream):
+        """Stop an input stream without closing it.
+
+        Avoid to fill the input buffer of the stream while nothing is
+        recorded. The stream is started again by getInputStream.
+
+        :param stream: Input stream returned by getInputStream.
+        """
+        with self.lock:
+            if not stream.is_stopped():
+                stream.stop_stream()
+
+    def close(self):
+        """Close all the streams and terminate the PyAudio object."""
+        with self.lock:
+            for stream in list(self.outputStreams.values()) + \
+                    list(self.inputStreams.values()) + self.callbackStreams:
+                try:
+                    stream.stop_stream()
+                    stream.close()
+                except Exception as e:
+                    print("Exception: " + str(e))
+
+            self.outputStreams = {}
+            self.inputStreams = {}
+            self.callbackStreams = []
+
+            if self.pyAudio is not None:
+                self.pyAudio.terminate()
+                self.pyAudio = None
+
+
+class RingBufferRecorder():
+    """RingBufferRecorder class.
+
+    This class records audio continuously in background, using the callback
+    mode of PyAudio. The samples are written in a preallocated ring buffer
+    such that only the last seconds of audio are kept, whatever the duration
+    of the recording.
+    """
+
+    def __init__(self, audioContext, bufferTime=30, rate=44100, channels=2,
+                 chunk=1024):
+        """Allocate the ring buffer.
+
+        :param audioContext: Instance of the AudioContext class used to open
+                             the input stream.
+        :param bufferTime: Duration of audio kept in the buffer.
+        :param rate: Number of frames per second.
+        :param channels: Number of samples per frame.
+        :param chunk: Number of frames given at once by the callback.
+        """
+        self.audioContext = audioContext
+        self.rate = rate
+        self.channels = channels
+        self.chunk = chunk
+
+        self.capacity = int(bufferTime * rate)
+        self.buffer = np.zeros((self.capacity, channels), dtype=np.int16)
+
+        # index of the next frame to be written and number of valid frames
+        self.writeIndex = 0
+        self.availableFrames = 0
+
+        self.lock = Lock()
+        self.stream = None
+
+    def callback(self, inData, frameCount, timeInfo, status):
+        """Copy the recorded frames in the ring buffer.
+
+        Called by PyAudio from its own thread each time a chunk is recorded.
+        """
+        frames = np.frombuffer(inData, dtype=np.int16)
+        frames = frames.reshape(-1, self.channels)[-self.capacity:]
+        length = len(frames)
+
+        with self.lock:
+            end = self.writeIndex + length
+            if end <= self.capacity:
+                self.buffer[self.writeIndex:end] = frames
+            else:
+                split = self.capacity - self.writeIndex
+                self.buffer[self.writeIndex:] = frames[:split]
+                self.buffer[:length - split] = frames[split:]
+
+            self.writeIndex = end % self.capacity
+            self.availableFrames = min(self.availableFrames + length,
+                                       self.capacity)
+
+        return (None, pyaudio.paContinue)
+
+    def start(self):
+        """Start the recording in background."""
+        if self.stream is not None:
+            return
+
+        with self.lock:
+            self.writeIndex = 0
+            self.availableFrames = 0
+
+        self.stream = self.audioContext.openCallbackStream(pyaudio.paInt16,
+                                                           self.channels,
+                                                           self.rate,
+                                                           self.chunk,
+                                                           self.callback)
+
+    def stop(self):
+        """Stop the recording, the buffer keeps the recorded audio.
+
+        The stream may already have been closed with the audio context.
+        """
+        if self.stream is not None:
+            self.audioContext.closeStream(self.stream)
+            self.stream = None
+
+    def isRecording(self):
+        """Return if the recording in background is running.
+
+        :return: True if the recording is running, False otherwise.
+        """
+        try:
+            return self.stream is not None and self.stream.is_active()
+        except Exception:
+            # The stream was closed with the audio context
+            return False
+
+    def snapshot(self, seconds=None):
+        """Return the last recorded frames without copying them.
+
+        As the requested frames may wrap around the end of the ring buffer,
+        they are returned as one or two NumPy views of the buffer in
+        chronological order. The views are only valid until the recording
+        overwrites them, copy them if they have to be kept longer.
+
+        :param seconds: Duration of audio to return, all the available audio
+                        is returned by default.
+        :return: List of arrays of shape (frames, channels).
+        """
+        with self.lock:
+            length = self.availableFrames
+            if seconds is not None:
+                length = min(length, int(seconds * self.rate))
+
+            start = self.writeIndex - length
+            if start >= 0:
+                return [self.buffer[start:self.writeIndex]]
+
+            return [self.buffer[start:], self.buffer[:self.writeIndex]]
+
+    def save(self, wavOutputFileName, seconds=None):
+        """Save the last recorded frames as a WAV file.
+
+        :param wavOutputFileName: Name of the WAV output file.
+        :param seconds: Duration of audio to save, all the available audio is
+                        saved by default.
+        """
+        wf = wave.open(wavOutputFileName, 'wb')
+        wf.setnchannels(self.channels)
+        wf.setsampwidth(pyaudio.get_sample_size(pyaudio.paInt16))
+        wf.setframerate(self.rate)
+        for view in self.snapshot(seconds):
+            wf.writeframes(memoryview(view).cast('B'))
+        wf.close()
 
 
 class ReachyAudioPlayerRecorder():
@@ -25,20 +378,99 @@ class ReachyAudioPlayerRecorder():
         # number of bytes per sample
         self.format = pyaudio.paInt16
 
-    def recordAudio(self, recordTime=5, wavOutputFileName="output.wav"):
+        # keep the audio streams open between recordings and playbacks
+        self.audioContext = AudioContext()
+
+        # recorder running in background, if any
+        self.backgroundRecorder = None
+
+    def closeAudio(self):
+        """Close the audio streams kept open by the player and the recorder."""
+        self.stopBackgroundRecording()
+        self.audioContext.close()
+
+    def startBackgroundRecording(self, bufferTime=30):
+        """Record audio continuously in background without blocking.
+
+        Only the last bufferTime seconds of audio are kept in memory.
+
+        :param bufferTime: Duration of audio kept by the recorder.
+        """
+        self.stopBackgroundRecording()
+
+        try:
+            self.backgroundRecorder = RingBufferRecorder(self.audioContext,
+                                                         bufferTime,
+                                                         self.rate,
+                                                         self.channels,
+                                                         self.chunk)
+            self.backgroundRecorder.start()
+
+        except Exception as e:
+            print("Exception: " + str(e))
+            self.backgroundRecorder = None
+
+    def stopBackgroundRecording(self):
+        """Stop the recording in background."""
+        if self.backgroundRecorder is not None:
+            self.backgroundRecorder.stop()
+
+    def getLastAudio(self, seconds=None):
+        """Return the last seconds recorded in background without copy.
+
+        :param seconds: Duration of audio to return, all the available audio
+                        is returned by default.
+        :return: List of one or two NumPy views of the recorded frames in
+                 chronological order (see RingBufferRecorder.snapshot).
+        """
+        if self.backgroundRecorder is None:
+            return []
+
+        return self.backgroundRecorder.snapshot(seconds)
+
+    def saveLastAudio(self, seconds=None, wavOutputFileName="output.wav"):
+        """Save the last seconds recorded in background as a WAV file.
+
+        :param seconds: Duration of audio to save, all the available audio is
+                        saved by default.
+        :param wavOutputFileName: Name of the WAV output file.
+        """
+        if self.backgroundRecorder is None:
+            print("No audio recorded in background.")
+            return
+
+        try:
+            self.backgroundRecorder.save(wavOutputFileName, seconds)
+
+        except Exception as e:
+            print("Exception: " + str(e))
+
+    def recordAudio(self, recordTime=5, wavOutputFileName="output.wav",
+                    streamToFile=False):
         """Record audio samples and save them as a WAV file.
 
         :param recordTime: Duration of the recording.
         :param wavOutputFileName: Name of the WAV output file.
+        :param streamToFile: If each recorded chunk should be written to the
+                             WAV file as soon as it is recorded instead of
+                             keeping the whole recording in memory. The header
+                             of the file is completed at the end.
         """
+        stream = None
+        wf = None
+
         try:
-            # Create the PyAudio object and open the PyAudio stream
-            p = pyaudio.PyAudio()
-            stream = p.open(format=self.format,
-                            channels=self.channels,
-                            rate=self.rate,
-                            input=True,
-                            frames_per_buffer=self.chunk)
+            # Open the WAV file
+            wf = wave.open(wavOutputFileName, 'wb')
+            wf.setnchannels(self.channels)
+            wf.setsampwidth(pyaudio.get_sample_size(self.format))
+            wf.setframerate(self.rate)
+
+            # Get the PyAudio input stream
+            stream = self.audioContext.getInputStream(self.format,
+                                                      self.channels,
+                                                      self.rate,
+                                                      self.chunk)
 
             print("* recording")
 
@@ -49,41 +481,56 @@ class ReachyAudioPlayerRecorder():
             # the number of loops has to be divided by the chunk size
             for _ in range(int(self.rate / self.chunk * recordTime)):
                 data = stream.read(self.chunk)
-                frames.append(data)
+                if streamToFile:
+                    wf.writeframesraw(data)
+                else:
+                    frames.append(data)
 
             print("* done recording")
 
-            # Close and terminate the PyAudio processes
-            stream.stop_stream()
-            stream.close()
-            p.terminate()
+            # Stop the stream until the next recording
+            self.audioContext.pauseInputStream(stream)
 
-            # Save the recorded audio data
-            wf = wave.open(wavOutputFileName, 'wb')
-            wf.setnchannels(self.channels)
-            wf.setsampwidth(p.get_sample_size(self.format))
-            wf.setframerate(self.rate)
+            # Save the recorded audio data, closing the file patches the
+            # header with the number of frames written
             wf.writeframes(b''.join(frames))
-            wf.close()
 
         except Exception as e:
             print("Exception: " + str(e))
+            # Only the stream used is closed, it is opened again next time
+            if stream is not None:
+                self.audioContext.closeStream(stream)
 
-    def playAudio(self, wavFileName):
+        finally:
+            if wf is not None:
+                wf.close()
+
+    def playAudio(self, wavFileName, memoryMapped=False):
         """Play a WAV file.
 
         :param wavFileName: Name of the WAV file to play.
+        :param memoryMapped: If the file should be memory mapped and its
+                             samples given to the audio stream without being
+                             copied, instead of being read chunk by chunk.
         """
+        stream = None
+        wf = None
+
         try:
             # Open the wav file
             wf = wave.open(wavFileName, 'rb')
 
-            # Create the PyAudio object and open the PyAudio stream
-            p = pyaudio.PyAudio()
-            stream = p.open(format=p.get_format_from_width(wf.getsampwidth()),
-                            channels=wf.getnchannels(),
-                            rate=wf.getframerate(),
-                            output=True)
+            if memoryMapped:
+                wf.close()
+                self.playMappedAudio(wavFileName, wf.getframerate(),
+                                     wf.getnchannels(), wf.getsampwidth())
+                return
+
+            # Get the PyAudio output stream
+            stream = self.audioContext.getOutputStream(
+                pyaudio.get_format_from_width(wf.getsampwidth()),
+                wf.getnchannels(),
+                wf.getframerate())
 
             # Read the wav file until his end
             data = wf.readframes(self.chunk)
@@ -92,13 +539,81 @@ class ReachyAudioPlayerRecorder():
                 stream.write(data)
                 data = wf.readframes(self.chunk)
 
-            # Terminate and close all the processes
-            stream.stop_stream()
-            stream.close()
+        except Exception as e:
+            print("Exception: " + str(e))
+            # Only the stream used is closed, it is opened again next time
+            if stream is not None:
+                self.audioContext.closeStream(stream)
+
+        finally:
+            if wf is not None:
+                wf.close()
+
+    def playMappedAudio(self, wavFileName, rate, channels, sampleWidth):
+        """Play the samples of a WAV file by memory mapping it.
+
+        :param wavFileName: Name of the WAV file to play.
+        :param rate: Number of frames per second of the file.
+        :param channels: Number of samples per frame of the file.
+        :param sampleWidth: Number of bytes per sample of the file.
+        """
+        with open(wavFileName, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                offset, size = findWavData(mm)
+                with memoryview(mm) as view:
+                    self.playBuffer(view[offset:offset + size], rate,
+                                    channels, sampleWidth)
+
+    def playBuffer(self, buffer, rate, channels=1, sampleWidth=2):
+        """Play audio samples stored in memory.
+
+        The samples are given to the audio stream chunk by chunk as views of
+        the buffer, such that they are never copied.
 
-            p.terminate()
+        :param buffer: Audio samples to play, either a NumPy array or any
+                       object supporting the buffer protocol (bytes,
+                       memoryview, mmap...) containing interleaved samples.
+        :param rate: Number of frames per second of the samples.
+        :param channels: Number of samples per frame.
+        :param sampleWidth: Number of bytes per sample. Ignored for NumPy
+                            arrays as it is given by their data type.
+        """
+        if isinstance(buffer, np.ndarray):
+            sampleWidth = buffer.dtype.itemsize
+        data = bytesView(buffer)
+
+        # Split the samples into chunks
+        chunkSize = self.chunk * channels * sampleWidth
+        blocks = (data[start:start + chunkSize]
+                  for start in range(0, len(data), chunkSize))
+
+        self.playBlocks(blocks, rate, channels, sampleWidth)
+
+    def playBlocks(self, blocks, rate, channels=1, sampleWidth=2):
+        """Play audio samples as soon as they are produced.
+
+        The blocks are written to the audio stream one after the other, such
+        that the playback starts as soon as the first block is available.
+
+        :param blocks: Iterable of audio blocks, either NumPy arrays or any
+                       object supporting the buffer protocol containing
+                       interleaved samples.
+        :param rate: Number of frames per second of the samples.
+        :param channels: Number of samples per frame.
+        :param sampleWidth: Number of bytes per sample.
+        """
+        stream = None
+
+        try:
+            # Get the PyAudio output stream
+            stream = self.audioContext.getOutputStream(
+                pyaudio.get_format_from_width(sampleWidth), channels, rate)
 
-            wf.close()
+            for block in blocks:
+                stream.write(bytesView(block))
 
         except Exception as e:
             print("Exception: " + str(e))
+            # Only the stream used is closed, it is opened again next time
+            if stream is not None:
+                self.audioContext.closeStream(stream)
@@ -0,0 +1,165 @@
+"""This module defines the recognizer backends used to recognize speech.
+
+The backend is chosen by name, either explicitly or with the environment
+variable REACHY_AUDIO_RECOGNIZER (ex: REACHY_AUDIO_RECOGNIZER=vosk):
+
+- google: Google Web Speech API (default, requires an internet connection).
+- sphinx: CMU PocketSphinx, runs locally.
+- vosk: Vosk (Kaldi) model, runs locally.
+- fake: replays fixture sentences, without recognizing anything.
+"""
+
+import os
+import json
+from .reachyAudioLazyImport import lazyImport
+
+# The recognition libraries are only imported when a backend is used
+sr = lazyImport("speech_recognition")
+vosk = lazyImport("vosk")
+
+# Environment variable giving the name of the default backend
+RECOGNIZER_BACKEND_VARIABLE = "REACHY_AUDIO_RECOGNIZER"
+
+DEFAULT_RECOGNIZER_BACKEND = "google"
+
+# Directory containing the Vosk model (see https://alphacephei.com/vosk/models)
+VOSK_MODEL_DIRECTORY = "utils/vosk_model"
+
+# Sample rate expected by the Vosk models
+VOSK_RATE = 16000
+
+
+class RecognizerBackend():
+    """RecognizerBackend class.
+
+    Base class of the recognizer backends. A backend converts the audio data
+    captured by a recognizer of the SpeechRecognition library into text.
+    """
+
+    name = None
+
+    # If the backend recognizes audio data, i.e. needs a microphone
+    usesAudio = True
+
+    def recognize(self, recognizer, audio):
+        """Recognize the text said in audio data.
+
+        :param recognizer: Instance of the Recognizer class.
+        :param audio: Instance of the AudioData class.
+        :return: The recognized text. Raise speech_recognition's
+                 UnknownValueError if nothing could be recognized.
+        """
+        raise NotImplementedError
+
+
+class GoogleRecognizerBackend(RecognizerBackend):
+    """Recognize speech with the Google Web Speech API."""
+
+    name = "google"
+
+    def recognize(self, recognizer, audio):
+        return recognizer.recognize_google(audio)
+
+
+class SphinxRecognizerBackend(RecognizerBackend):
+    """Recognize speech locally with CMU PocketSphinx."""
+
+    name = "sphinx"
+
+    def recognize(self, recognizer, audio):
+        return recognizer.recognize_sphinx(audio)
+
+
+class VoskRecognizerBackend(RecognizerBackend):
+    """Recognize speech locally with a Vosk model."""
+
+    name = "vosk"
+
+    def __init__(self, modelDirectory=VOSK_MODEL_DIRECTORY):
+        """Load the Vosk model.
+
+        :param modelDirectory: Directory containing the model.
+        """
+        vosk.SetLogLevel(-1)
+        self.model = vosk.Model(modelDirectory)
+
+    def recognize(self, recognizer, audio):
+        rec = vosk.KaldiRecognizer(self.model, VOSK_RATE)
+        rec.AcceptWaveform(audio.get_raw_data(convert_rate=VOSK_RATE,
+                                              convert_width=2))
+        text = json.loads(rec.FinalResult()).get("text", "")
+
+        if not text:
+            raise sr.UnknownValueError()
+
+        return text
+
+
+class FakeRecognizerBackend(RecognizerBackend):
+    """Replay fixture sentences instead of recognizing speech.
+
+    Each call returns the next sentence, whatever the audio data. It allows
+    to test the conversation without a microphone or a recognition engine.
+    """
+
+    name = "fake"
+    usesAudio = False
+
+    def __init__(self, sentences=None, fixtureFileName=None):
+        """Initialize the sentences to replay.
+
+        :param sentences: List of the sentences to replay.
+        :param fixtureFileName: JSON file containing the list of the
+                                sentences to replay, used if sentences is
+                                None.
+        """
+        if sentences is None and fixtureFileName is not None:
+            with open(fixtureFileName) as fixtureFile:
+                sentences = json.load(fixtureFile)
+
+        self.sentences = list(sentences or [])
+        self.index = 0
+
+    def recognize(self, recognizer, audio):
+        if self.index >= len(self.sentences):
+            raise sr.UnknownValueError()
+
+        sentence = self.sentences[self.index]
+        self.index += 1
+
+        return sentence
+
+
+RECOGNIZER_BACKENDS = {
+    backend.name: backend for backend in (GoogleRecognizerBackend,
+                                          SphinxRecognizerBackend,
+                                          VoskRecognizerBackend,
+                                          FakeRecognizerBackend)
+}
+
+
+def createRecognizerBackend(name=None, **parameters):
+    """Create a recognizer backend from its name.
+
+    :param name: Name of the backend (google, sphinx, vosk or fake). If None,
+                 the environment variable REACHY_AUDIO_RECOGNIZER gives it,
+                 google is used if it is not set either. An instance of
+                 RecognizerBackend is returned as it is.
+    :param parameters: Parameters given to the constructor of the backend
+                       (ex: modelDirectory for vosk).
+    :return: Instance of a subclass of RecognizerBackend.
+    """
+    if isinstance(name, RecognizerBackend):
+        return name
+
+    if name is None:
+        name = os.environ.get(RECOGNIZER_BACKEND_VARIABLE,
+                              DEFAULT_RECOGNIZER_BACKEND)
+
+    try:
+        backend = RECOGNIZER_BACKENDS[name.lower()]
+    except KeyError:
+        raise ValueError('{} is not a recognizer backend, use one of: {}'
+                         .format(name, ', '.join(RECOGNIZER_BACKENDS)))
+
+    return backend(**parameters)
@@ -0,0 +1,228 @@
+"""This module defines the SpeechCache class."""
+
+import os
+import json
+import wave
+import hashlib
+import numpy as np
+from threading import Lock
+from collections import OrderedDict
+
+# NumPy type of the samples depending on their number of bytes
+SAMPLE_TYPES = {1: np.uint8, 2: np.int16, 4: np.int32}
+
+
+def readWavFile(wavFileName):
+    """Read the samples of a WAV file.
+
+    :param wavFileName: Name of the WAV file to read.
+    :return: The rate, the number of channels and the samples of the file.
+    """
+    with wave.open(wavFileName, 'rb') as wf:
+        rate = wf.getframerate()
+        channels = wf.getnchannels()
+        sampleType = SAMPLE_TYPES[wf.getsampwidth()]
+        data = np.frombuffer(wf.readframes(wf.getnframes()), dtype=sampleType)
+
+    return rate, channels, data
+
+
+def writeWavFile(wavFileName, rate, channels, data):
+    """Write samples in a WAV file.
+
+    :param wavFileName: Name of the WAV file to write.
+    :param rate: Number of frames per second of the samples.
+    :param channels: Number of samples per frame.
+    :param data: NumPy array of interleaved samples.
+    """
+    with wave.open(wavFileName, 'wb') as wf:
+        wf.setnchannels(channels)
+        wf.setsampwidth(data.dtype.itemsize)
+        wf.setframerate(rate)
+        wf.writeframes(np.ascontiguousarray(data).tobytes())
+
+
+class SpeechCache():
+    """SpeechCache class.
+
+    This class stores rendered speech such that a text already said does not
+    have to be synthesized again. Each entry is identified by a hash of the
+    text and of the properties used to render it. The entries are kept both
+    in memory and on disk (as WAV files), each one being bounded in size: the
+    least recently used entries are evicted first.
+
+    A read-only cache (ex: a bundle of pre-rendered responses) can be given
+    as the bundle of another cache, whose entries are looked up in the bundle
+    when they are missing, while its new entries are stored apart.
+    """
+
+    def __init__(self, directory="utils/speech_cache",
+                 memorySize=50*2**20, diskSize=500*2**20, readOnly=False,
+                 bundle=None):
+        """Initialize the cache.
+
+        :param directory: Directory in which the entries are stored on disk,
+                          None to only keep them in memory.
+        :param memorySize: Maximum number of bytes of samples kept in memory.
+        :param diskSize: Maximum number of bytes of WAV files kept on disk,
+                         None to never remove them.
+        :param readOnly: If the new entries should only be kept in memory,
+                         without changing the files on disk.
+        :param bundle: Instance of the SpeechCache class in which the entries
+                       missing from this cache are looked up.
+        """
+        self.directory = directory
+        self.memorySize = memorySize
+        self.diskSize = diskSize
+        self.readOnly = readOnly
+        self.bundle = bundle
+
+        self.memory = OrderedDict()
+        self.memoryUsage = 0
+        self.lock = Lock()
+
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(text, properties):
+        """Compute the key identifying a rendered speech.
+
+        :param text: Text that is said.
+        :param properties: Dictionary of the properties used to render the
+                           speech (engine rate, volume, voice, altered...).
+        :return: Hexadecimal digest identifying the speech.
+        """
+        content = json.dumps({'text': text, 'properties': properties},
+                             sort_keys=True)
+
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        """Return the path of the WAV file storing an entry.
+
+        :param key: Key of the entry.
+        :return: Path of the WAV file.
+        """
+        return os.path.join(self.directory, key + '.wav')
+
+    def __contains__(self, key):
+        """Return if a rendered speech is in the cache, without loading it.
+
+        :param key: Key of the entry.
+        :return: True if the entry is in memory, on disk or in the bundle,
+                 False otherwise.
+        """
+        with self.lock:
+            if key in self.memory:
+                return True
+
+        if self.directory is not None and os.path.exists(self.path(key)):
+            return True
+
+        return self.bundle is not None and key in self.bundle
+
+    def get(self, key):
+        """Return a rendered speech if it is in the cache.
+
+        :param key: Key of the entry.
+        :return: The rate, the number of channels and the samples of the
+                 speech, None if it is not in the cache.
+        """
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+
+        if self.directory is None or not os.path.exists(self.path(key)):
+            if self.bundle is not None:
+                return self.bundle.get(key)
+            return None
+
+        try:
+            entry = readWavFile(self.path(key))
+            # Mark the file as recently used
+            os.utime(self.path(key))
+        except Exception as e:
+            print("Exception: " + str(e))
+            return None
+
+        self.putInMemory(key, entry)
+
+        return entry
+
+    def put(self, key, rate, channels, data):
+        """Add a rendered speech to the cache.
+
+        :param key: Key of the entry.
+        :param rate: Number of frames per second of the samples.
+        :param channels: Number of samples per frame.
+        :param data: NumPy array of interleaved samples.
+        """
+        self.putInMemory(key, (rate, channels, data))
+
+        if self.directory is None or self.readOnly:
+            return
+
+        try:
+            # Write in a temporary file first such that an incomplete file is
+            # never read from the cache
+            temporaryFileName = self.path(key) + '.tmp'
+            writeWavFile(temporaryFileName, rate, channels, data)
+            os.replace(temporaryFileName, self.path(key))
+        except Exception as e:
+            print("Exception: " + str(e))
+
+        self.evictFromDisk()
+
+    def putInMemory(self, key, entry):
+        """Add an entry in memory and evict the least recently used ones.
+
+        :param key: Key of the entry.
+        :param entry: Tuple of the rate, channels and samples of the entry.
+        """
+        with self.lock:
+            if key in self.memory:
+                self.memoryUsage -= self.memory.pop(key)[2].nbytes
+
+            self.memory[key] = entry
+            self.memoryUsage += entry[2].nbytes
+
+            while self.memoryUsage > self.memorySize and len(self.memory) > 1:
+                _, evicted = self.memory.popitem(last=False)
+                self.memoryUsage -= evicted[2].nbytes
+
+    def evictFromDisk(self):
+        """Remove the least recently used files above the disk size."""
+        if self.diskSize is None:
+            return
+
+        with self.lock:
+            files = []
+            for fileName in os.listdir(self.directory):
+                if fileName.endswith('.wav'):
+                    stat = os.stat(os.path.join(self.directory, fileName))
+                    files.append((stat.st_mtime, stat.st_size, fileName))
+
+            diskUsage = sum(size for _, size, _ in files)
+
+            for _, size, fileName in sorted(files):
+                if diskUsage <= self.diskSize:
+                    break
+                os.remove(os.path.join(self.directory, fileName))
+                diskUsage -= size
+
+    def clear(self):
+        """Remove all the entries of the cache, in memory and on disk.
+
+        The entries of the bundle are kept, and the files of a read-only
+        cache are not removed.
+        """
+        with self.lock:
+            self.memory = OrderedDict()
+            self.memoryUsage = 0
+
+            if self.directory is not None and not self.readOnly:
+                for fileName in os.listdir(self.directory):
+                    if fileName.endswith('.wav'):
+                        os.remove(os.path.join(self.directory, fileName))
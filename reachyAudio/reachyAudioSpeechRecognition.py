@@ -1,37 +1,91 @@
 """This module defines the ReachyAudioSpeechRecognition class."""
 
-import speech_recognition as sr
+import asyncio
+from threading import Event, Thread
+from .reachyAudioLazyImport import lazyImport
+from .reachyAudioStateChannel import StateChannel
+from .reachyAudioRecognizerBackends import createRecognizerBackend
 
-detectedSentence = ""
-robotSpeaking = False
+# SpeechRecognition is only imported when the recognizer is initialized
+sr = lazyImport("speech_recognition")
 
+# Time between two calls to a backend which does not use audio data (the fake
+# backend) when listening in background, in seconds
+REPLAY_PERIOD = 0.5
 
-def speechRecognitionCallback(recognizer, audio):
-    """Recognize the received audio data and update detectedSentence.
+
+def speechRecognitionCallback(recognizer, audio, sentenceChannel,
+                              robotSpeaking, recognizerBackend):
+    """Recognize the received audio data and publish the detected sentence.
 
     The callback called when we receive audio data (when the interlocutor
     stopped to speak).
-    """
-    global robotSpeaking
-    global detectedSentence
 
-    if not robotSpeaking:
+    :param recognizer: Instance of the Recognizer class.
+    :param audio: The received audio data.
+    :param sentenceChannel: Instance of the StateChannel class in which the
+                            detected sentence is published.
+    :param robotSpeaking: Event set while the robot is speaking.
+    :param recognizerBackend: Instance of the RecognizerBackend class
+                              converting the audio data into text.
+    """
+    if not robotSpeaking.is_set():
         try:
-            detectedSentence = recognizer.recognize_google(audio)
+            sentenceChannel.publish(recognizerBackend.recognize(recognizer,
+                                                                audio))
         except:
-            detectedSentence = ""
+            sentenceChannel.clear()
 
 
 class ReachyAudioSpeechRecognition():
     """The ReachySpeechRecognition class allows Reachy to recognize speech."""
 
-    def __init__(self):
-        """Initialize the microphone and the recognizer objects."""
+    # Attributes set by the methods of this class, to be updated when one is
+    # added. ReachyAudio initializes this class when one of them is used
+    lazyAttributes = ('microphone', 'recognizer', 'recognizerBackend',
+                      'robotSpeaking', 'sentenceChannel')
+
+    def __init__(self, recognizerBackend=None):
+        """Initialize the microphone and the recognizer objects.
+
+        The microphone is neither opened nor calibrated if the backend does
+        not use audio data (fake backend).
+
+        :param recognizerBackend: Name of the backend converting speech into
+                                  text (google, sphinx, vosk or fake), or an
+                                  instance of RecognizerBackend. If None, the
+                                  environment variable REACHY_AUDIO_RECOGNIZER
+                                  gives it, google is used if it is not set
+                                  either.
+        """
         print("Recognizer initialization...")
+        self.sentenceChannel = StateChannel("")
+        self.robotSpeaking = Event()
+        self.recognizerBackend = createRecognizerBackend(recognizerBackend)
+        self.microphone = None
+        self.recognizer = None
+        if self.recognizerBackend.usesAudio:
+            self.initializeAudioInput()
+        print("Done")
+
+    def initializeAudioInput(self):
+        """Initialize and calibrate the microphone and the recognizer."""
         self.microphone = self.initializeMicrophone()
         self.recognizer = self.initializeRecognizer()
         self.calibrateRecognizer()
-        print("Done")
+
+    def setRecognizerBackend(self, name, **parameters):
+        """Change the backend converting speech into text.
+
+        :param name: Name of the backend (google, sphinx, vosk or fake), or an
+                     instance of RecognizerBackend.
+        :param parameters: Parameters of the backend (ex: modelDirectory for
+                           vosk, sentences or fixtureFileName for fake).
+        """
+        self.recognizerBackend = createRecognizerBackend(name, **parameters)
+
+        if self.recognizerBackend.usesAudio and self.microphone is None:
+            self.initializeAudioInput()
 
     def initializeRecognizer(self):
         """Initialize the recognizer object.
@@ -62,6 +116,15 @@ class ReachyAudioSpeechRecognition():
         :return: The recognized text if the recognition worked or an empty
                  string otherwise.
         """
+        if self.microphone is None:
+            # The backend does not use audio data
+            try:
+                said = self.recognizerBackend.recognize(None, None)
+                print(said)
+            except:
+                said = ""
+            return said.lower()
+
         with self.microphone as source:
             print("Say something")
 
@@ -69,7 +132,8 @@ class ReachyAudioSpeechRecognition():
             said = ""
 
             try:
-                said = self.recognizer.recognize_google(audio)
+                said = self.recognizerBackend.recognize(self.recognizer,
+                                                        audio)
                 print(said)
             except:
                 print("Sorry, I haven't understand you properly, \
@@ -77,31 +141,99 @@ class ReachyAudioSpeechRecognition():
 
             return said.lower()
 
+    async def recognizeSpeechAsync(self):
+        """Coroutine recognizing the incomming speech in another thread.
+
+        :return: The recognized text if the recognition worked or an empty
+                 string otherwise.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.recognizeSpeech)
+
+    def listenInBackground(self):
+        """Recognize speech in background and publish the detected sentences.
+
+        :return: Function stopping the recognition, taking the parameter
+                 wait_for_stop (see listen_in_background of the Recognizer
+                 class).
+        """
+        if self.microphone is not None:
+            return self.recognizer.listen_in_background(
+                self.microphone, self.recognitionCallback)
+
+        # Without a microphone (fake backend), the backend is called each
+        # time the previous sentence has been handled
+        stopped = Event()
+
+        def replay():
+            while not stopped.is_set():
+                if not self.robotSpeaking.is_set() and \
+                        self.getDetectedSentence() == "":
+                    self.recognitionCallback(None, None)
+                stopped.wait(REPLAY_PERIOD)
+
+        thread = Thread(target=replay, daemon=True)
+        thread.start()
+
+        def stop(wait_for_stop=True):
+            stopped.set()
+            if wait_for_stop:
+                thread.join()
+
+        return stop
+
+    def recognitionCallback(self, recognizer, audio):
+        """Callback given to the background listener of the recognizer.
+
+        Recognize the received audio data and publish the detected sentence
+        in the channel of this object.
+        """
+        speechRecognitionCallback(recognizer, audio, self.sentenceChannel,
+                                  self.robotSpeaking, self.recognizerBackend)
+
     def getDetectedSentence(self):
         """Get the last detected sentence.
 
         :return: The last detected sentence.
         """
-        global detectedSentence
-        return detectedSentence
+        return self.sentenceChannel.get()
+
+    def waitForDetectedSentence(self, timeout=None):
+        """Wait until a sentence is detected.
+
+        :param timeout: Maximum waiting time in seconds, None to wait
+                        indefinitely.
+        :return: The detected sentence, or an empty string if the timeout
+                 expired first.
+        """
+        return self.sentenceChannel.waitFor(timeout)
+
+    async def waitForDetectedSentenceAsync(self, timeout=None):
+        """Coroutine waiting in another thread until a sentence is detected.
+
+        :param timeout: Maximum waiting time in seconds, None to wait
+                        indefinitely.
+        :return: The detected sentence, or an empty string if the timeout
+                 expired first.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.sentenceChannel.waitFor,
+                                          timeout)
 
     def clearDetectedSentence(self):
         """Clear the last detected sentence."""
-        global detectedSentence
-        detectedSentence = ""
+        self.sentenceChannel.clear()
 
     def setRobotSpeaking(self):
         """Set that the robot is currently speaking.
 
         Allow to not run the code in the recognition thread.
         """
-        global robotSpeaking
-        robotSpeaking = True
+        self.robotSpeaking.set()
 
     def clearRobotSpeaking(self):
         """Set that the robot is not speaking anymore.
 
         Allow to run the code in the recognition thread.
         """
-        global robotSpeaking
-        robotSpeaking = False
+        self.robotSpeaking.clear()
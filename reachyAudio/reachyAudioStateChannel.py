@@ -0,0 +1,60 @@
+"""This module defines the StateChannel class."""
+
+from threading import Condition
+
+
+class StateChannel():
+    """StateChannel class.
+
+    Thread-safe value shared between a thread producing it (the recognition
+    thread for the detected sentence, the recording thread for the detected
+    angle) and the threads using it. The consumers can block until a value is
+    published instead of polling it.
+    """
+
+    def __init__(self, emptyValue):
+        """Initialize the channel.
+
+        :param emptyValue: Value of the channel when nothing has been
+                           published (ex: "" for a sentence, -1.0 for an
+                           angle).
+        """
+        self.emptyValue = emptyValue
+        self.value = emptyValue
+        self.condition = Condition()
+
+    def publish(self, value):
+        """Set the value of the channel and wake up the waiting threads.
+
+        :param value: The new value.
+        """
+        with self.condition:
+            self.value = value
+            self.condition.notify_all()
+
+    def get(self):
+        """Return the current value of the channel, without waiting.
+
+        :return: The last published value, or the empty value if the channel
+                 has been cleared since.
+        """
+        with self.condition:
+            return self.value
+
+    def clear(self):
+        """Reset the channel to its empty value."""
+        with self.condition:
+            self.value = self.emptyValue
+
+    def waitFor(self, timeout=None):
+        """Wait until the channel holds a value.
+
+        :param timeout: Maximum waiting time in seconds, None to wait
+                        indefinitely.
+        :return: The value of the channel, or the empty value if the timeout
+                 expired first.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.value != self.emptyValue,
+                                    timeout)
+            return self.value
@@ -1,12 +1,344 @@
 """This module defines the ReachyAudioTextToSpeech class."""
 
+import io
+import os
+import re
+import json
 import time
-import pyttsx3
+import asyncio
+import hashlib
+import tempfile
+import functools
+import threading
+import multiprocessing
 import numpy as np
-import scipy.io.wavfile as sc
-from gtts import gTTS
-from pydub import AudioSegment
+from concurrent.futures import ThreadPoolExecutor
+from .reachyAudioLazyImport import lazyImport
 from .reachyAudioPlayerRecorder import ReachyAudioPlayerRecorder
+from .reachyAudioSpeechCache import SpeechCache, readWavFile
+from .reachyAudioAnswering import DEFAULT_ANSWER
+
+# The text to speech libraries are only imported when Reachy speaks
+gtts = lazyImport("gtts")
+pydub = lazyImport("pydub")
+pyttsx3 = lazyImport("pyttsx3")
+sc = lazyImport("scipy.io.wavfile")
+
+# Sample rate at which the altered voice is played
+ALTERED_VOICE_RATE = 22050
+
+# Number of samples altered at once by the streaming ring modulator
+STREAMING_BLOCK_SIZE = 2048
+
+# Maximum number of characters synthesized at once when streaming (gTTS
+# sends the text by parts of at most 100 characters anyway)
+STREAMING_SEGMENT_LENGTH = 100
+
+# Version of the format of the pre-rendered responses bundle, to be increased
+# when the rendering changes such that old bundles are rendered again
+SPEECH_BUNDLE_VERSION = 1
+
+# Text to speech engine of the processes pre-rendering the responses
+workerEngine = None
+
+
+def diode(signalArray):
+    """Apply an approximation of the diode non linearity model.
+
+    Vectorized version of the diode model used by the diode ring modulator:
+    the whole signal is processed by NumPy instead of a Python loop over
+    each sample.
+
+    :param signalArray: The signal to be altered.
+    :return: The signal altered by the diode non linearity.
+    """
+    signalArray = np.asarray(signalArray, dtype=np.float64)
+
+    # Negative samples are clipped to 0 before the power, which both applies
+    # the diode model and avoids computing powers of negative numbers
+    return 0.1*np.power(np.maximum(signalArray, 0.0), 1.7)
+
+
+def synthesizeVoiceToAlter(text):
+    """Synthesize the voice to be altered without using any file.
+
+    The speech is synthesized by gTTS into an in-memory MP3 stream which is
+    then decoded by pydub.
+
+    :param text: Text to be said.
+    :return: The samples of the synthesized voice.
+    """
+    mp3 = io.BytesIO()
+    gtts.gTTS(text).write_to_fp(mp3)
+    mp3.seek(0)
+
+    sound = pydub.AudioSegment.from_file(mp3, format='mp3').set_channels(1)
+
+    return np.array(sound.get_array_of_samples())
+
+
+def diodeRingModulation(data):
+    """Simulate a diode ring modulator electrical circuit on a signal.
+
+    :param data: The samples of the voice to be altered.
+    :return: The samples of the altered voice.
+    """
+    # Get maximum absolute value of input signal
+    maxVal = np.max(np.abs(data))
+
+    # Scale down the input signal
+    scaledData = data/maxVal
+
+    # Create carrier signal
+    fCarrier = 500
+    t = np.linspace(0, len(scaledData), len(scaledData))
+    carrier = np.sin(2*np.pi*fCarrier*t)
+
+    # Compute output of the ring modulator circuit
+    topFirst = carrier + 0.5*scaledData
+    top = diode(topFirst) + diode(-topFirst)
+
+    bottomFirst = carrier - 0.5*scaledData
+    bottom = diode(bottomFirst) + diode(-bottomFirst)
+
+    output = top - bottom
+
+    # Scale back
+    return np.int16(5*maxVal*output)
+
+
+def renderEngineVoice(engine, text):
+    """Render the voice of the text to speech engine without playing it.
+
+    :param engine: Instance of the pyttsx3 engine class.
+    :param text: Text to be said.
+    :return: The rate, the number of channels and the samples of the voice.
+    """
+    fileDescriptor, fileName = tempfile.mkstemp(suffix='.wav')
+    os.close(fileDescriptor)
+
+    try:
+        engine.save_to_file(text, fileName)
+        engine.runAndWait()
+        return readWavFile(fileName)
+    finally:
+        os.remove(fileName)
+
+
+def renderResponse(task):
+    """Render a response in a process pre-rendering the responses.
+
+    :param task: Tuple of the text to be said, the properties of the text to
+                 speech engine and if the voice should be altered.
+    :return: The task followed by the rate, the number of channels and the
+             samples of the speech.
+    """
+    global workerEngine
+    text, engineProperties, alteredVoice = task
+
+    if alteredVoice:
+        data = diodeRingModulation(synthesizeVoiceToAlter(text))
+        return task + (ALTERED_VOICE_RATE, 1, data)
+
+    # Each process has its own engine, initialized on its first task
+    if workerEngine is None:
+        workerEngine = pyttsx3.init()
+        workerEngine.setProperty('rate', engineProperties['rate'])
+        workerEngine.setProperty('volume', engineProperties['volume'])
+        workerEngine.setProperty('voice', engineProperties['voice'])
+
+    return task + renderEngineVoice(workerEngine, text)
+
+
+def storeRenderedResponses(speechCache, renderedResponses):
+    """Store rendered responses in a speech cache.
+
+    :param speechCache: Instance of the SpeechCache class.
+    :param renderedResponses: Iterable of the results of renderResponse.
+    """
+    for text, engineProperties, alteredVoice, rate, channels, data in \
+            renderedResponses:
+        key = SpeechCache.key(text, dict(engineProperties,
+                                         alteredVoice=alteredVoice))
+        speechCache.put(key, rate, channels, data)
+
+
+def prerenderResponses(engineProperties, intentsFileName="utils/intents.json",
+                       directory="utils/speech_bundle", processes=None,
+                       alteredVoices=(False, True)):
+    """Render all the responses of the intents file in a speech bundle.
+
+    The bundle is a speech cache directory along with a manifest storing the
+    version of the bundle, computed from the content of the intents file and
+    from the engine properties. The bundle is rendered again from scratch if
+    this version changed, otherwise only the missing responses are rendered.
+    The responses are rendered in parallel by a pool of processes. As
+    forking a process copies the locks held by its other threads, they are
+    rendered in this process if other threads are running (ex: from a
+    ReachyAudio object listening in background).
+
+    :param engineProperties: Dictionary of the rate, volume and voice of the
+                             text to speech engine.
+    :param intentsFileName: Name of the JSON file containing the responses.
+    :param directory: Directory in which the bundle is stored.
+    :param processes: Number of processes rendering the responses, the
+                      number of CPUs by default. They are rendered in this
+                      process if 1.
+    :param alteredVoices: Render the responses for each of these values of
+                          the alteredVoice parameter of speak.
+    :return: Instance of the SpeechCache class containing the responses.
+    """
+    with open(intentsFileName, "rb") as myFile:
+        intentsContent = myFile.read()
+
+    # Compute the version of the bundle
+    versionHash = hashlib.sha256(intentsContent)
+    versionHash.update(json.dumps({'format': SPEECH_BUNDLE_VERSION,
+                                   'engine': engineProperties},
+                                  sort_keys=True).encode('utf-8'))
+    version = versionHash.hexdigest()
+
+    speechCache = SpeechCache(directory, diskSize=None)
+    manifestFileName = os.path.join(directory, "manifest.json")
+
+    try:
+        with open(manifestFileName) as manifestFile:
+            upToDate = json.load(manifestFile)["version"] == version
+    except Exception:
+        upToDate = False
+
+    if not upToDate:
+        speechCache.clear()
+
+    # Find the responses which are not rendered yet, including the answer
+    # given when no intent is detected
+    texts = sorted({response
+                    for intent in json.loads(intentsContent)["intents"]
+                    for response in intent["responses"]} | {DEFAULT_ANSWER})
+    tasks = [(text, engineProperties, alteredVoice)
+             for text in texts for alteredVoice in alteredVoices
+             if SpeechCache.key(text, dict(engineProperties,
+                                           alteredVoice=alteredVoice))
+             not in speechCache]
+
+    if tasks:
+        print("Rendering {} responses...".format(len(tasks)))
+        if processes == 1 or threading.active_count() > 1:
+            storeRenderedResponses(speechCache, map(renderResponse, tasks))
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                storeRenderedResponses(
+                    speechCache, pool.imap_unordered(renderResponse, tasks))
+        print("Done")
+
+    with open(manifestFileName, "w") as manifestFile:
+        json.dump({"version": version}, manifestFile)
+
+    # The bundle is not changed by the texts said afterwards
+    speechCache.readOnly = True
+
+    return speechCache
+
+
+class StreamingDiodeRingModulator():
+    """Diode ring modulator processing a signal block by block.
+
+    Unlike diodeRingModulation, the carrier is a 500 Hz sine at the playback
+    sample rate whose phase is kept from one block to the next, such that
+    consecutive blocks can be played without discontinuity.
+    """
+
+    def __init__(self, rate=ALTERED_VOICE_RATE, fCarrier=500):
+        """Initialize the carrier of the modulator.
+
+        :param rate: Sample rate at which the altered voice is played.
+        :param fCarrier: Frequency of the carrier signal.
+        """
+        self.phaseIncrement = 2*np.pi*fCarrier/rate
+        self.phase = 0.0
+
+    def process(self, block, maxVal):
+        """Alter a block of the voice signal.
+
+        :param block: The samples of the block to be altered.
+        :param maxVal: Maximum absolute value of the signal the block belongs
+                       to, used to scale the block.
+        :return: The samples of the altered block.
+        """
+        # Scale down the input signal
+        scaledData = block/maxVal
+
+        # Create the carrier signal, continuing the previous block
+        phases = self.phase + self.phaseIncrement*np.arange(len(block))
+        carrier = np.sin(phases)
+        self.phase = (self.phase + self.phaseIncrement*len(block)) % (2*np.pi)
+
+        # Compute output of the ring modulator circuit
+        topFirst = carrier + 0.5*scaledData
+        top = diode(topFirst) + diode(-topFirst)
+
+        bottomFirst = carrier - 0.5*scaledData
+        bottom = diode(bottomFirst) + diode(-bottomFirst)
+
+        # Scale back
+        return np.int16(5*maxVal*(top - bottom))
+
+
+def splitSpeechSegments(text, maxLength=STREAMING_SEGMENT_LENGTH):
+    """Split a text into segments which can be synthesized one at a time.
+
+    The text is split into sentences, and the sentences longer than
+    maxLength are split at word boundaries (a word longer than maxLength is
+    cut).
+
+    :param text: Text to be said.
+    :param maxLength: Maximum number of characters of a segment.
+    :return: Generator of the segments.
+    """
+    for sentence in re.split(r'(?<=[.!?;:])\s+', text.strip()):
+        segment = ""
+        for word in sentence.split():
+            while len(word) > maxLength:
+                if segment:
+                    yield segment
+                    segment = ""
+                yield word[:maxLength]
+                word = word[maxLength:]
+
+            if segment and len(segment) + 1 + len(word) > maxLength:
+                yield segment
+                segment = ""
+
+            segment = word if not segment else segment + " " + word
+
+        if segment:
+            yield segment
+
+
+def streamAlteredVoice(text, blockSize=STREAMING_BLOCK_SIZE,
+                       segmentLength=STREAMING_SEGMENT_LENGTH):
+    """Synthesize and alter a text block by block.
+
+    The text is split into sentences, and the long sentences into segments
+    of at most segmentLength characters, which are synthesized one after the
+    other. Only one segment is held in memory at a time whatever the length
+    of the text.
+
+    :param text: Text to be said.
+    :param blockSize: Number of samples of each altered block.
+    :param segmentLength: Maximum number of characters synthesized at once.
+    :return: Generator of the altered blocks.
+    """
+    modulator = StreamingDiodeRingModulator()
+
+    for segment in splitSpeechSegments(text, segmentLength):
+        data = synthesizeVoiceToAlter(segment)
+        maxVal = np.max(np.abs(data))
+        if maxVal == 0:
+            continue
+
+        for start in range(0, len(data), blockSize):
+            yield modulator.process(data[start:start + blockSize], maxVal)
 
 
 class ReachyAudioTextToSpeech():
@@ -16,12 +348,22 @@ class ReachyAudioTextToSpeech():
     customization.
     """
 
+    # Attributes set by the methods of this class, to be updated when one is
+    # added. ReachyAudio initializes this class when one of them is used
+    lazyAttributes = ('engine', 'engineProperties',
+                      'reachyAudioPlayerRecorderObject', 'speechCache',
+                      'speechExecutor')
+
     def __init__(self):
         """Initialize the text to speech engine."""
         print("Text to speech engine initialization...")
         self.engine = self.initializeEngine()
         self.setEngineProperties()
         self.reachyAudioPlayerRecorderObject = ReachyAudioPlayerRecorder()
+        self.speechCache = None
+        # The engine can not be used by several threads at the same time, the
+        # asynchronous methods run it in a single thread
+        self.speechExecutor = ThreadPoolExecutor(max_workers=1)
         print("Done")
 
     def initializeEngine(self):
@@ -41,22 +383,146 @@ class ReachyAudioTextToSpeech():
         self.engine.setProperty('rate', rate)
         self.engine.setProperty('volume', volume)
         self.engine.setProperty('voice', voice_id)
+        self.engineProperties = {'rate': rate,
+                                 'volume': volume,
+                                 'voice': voice_id}
+
+    def enableSpeechCache(self, directory="utils/speech_cache",
+                          memorySize=50*2**20, diskSize=500*2**20):
+        """Keep the rendered speech such that repeated texts play at once.
+
+        :param directory: Directory in which the rendered speech is stored,
+                          None to only keep it in memory.
+        :param memorySize: Maximum number of bytes kept in memory.
+        :param diskSize: Maximum number of bytes kept on disk.
+        """
+        # Keep the pre-rendered responses, if any
+        bundle = None if self.speechCache is None else self.speechCache.bundle
+        self.speechCache = SpeechCache(directory, memorySize, diskSize,
+                                       bundle=bundle)
+
+    def prerenderResponses(self, intentsFileName="utils/intents.json",
+                           directory="utils/speech_bundle", processes=None):
+        """Render all the possible responses before they are said.
+
+        The responses of the intents file are rendered with the current
+        engine properties, both with the normal and the altered voice. The
+        rendered responses are stored on disk and are only rendered again if
+        the intents file or the engine properties change. They are then used
+        as the read-only bundle of the cache of rendered speech (enabled with
+        its default parameters if needed), such that the other texts said
+        are stored in the bounded cache and not in the bundle.
+
+        :param intentsFileName: Name of the JSON file containing the
+                                responses.
+        :param directory: Directory in which the rendered responses are
+                          stored.
+        :param processes: Number of processes rendering the responses, the
+                          number of CPUs by default. The responses are
+                          rendered in this process if other threads are
+                          running (ex: once listenInBackground is called).
+        """
+        bundle = prerenderResponses(self.engineProperties, intentsFileName,
+                                    directory, processes)
+
+        if self.speechCache is None:
+            self.enableSpeechCache()
+        self.speechCache.bundle = bundle
+
+    def disableSpeechCache(self):
+        """Stop using the cache of rendered speech."""
+        self.speechCache = None
+
+    def speechCacheKey(self, text, alteredVoice=False):
+        """Compute the key of a rendered speech in the cache.
+
+        :param text: Text to be said.
+        :param alteredVoice: If the voice is altered.
+        :return: Key of the speech in the cache.
+        """
+        properties = dict(self.engineProperties, alteredVoice=alteredVoice)
+
+        return SpeechCache.key(text, properties)
+
+    def renderSpeech(self, text, alteredVoice=False):
+        """Render the speech of a text without playing it.
+
+        The speech is taken from the cache if it is enabled and already
+        contains it, the rendered speech is added to the cache otherwise.
 
-    def speak(self, text, alteredVoice=False):
+        :param text: Text to be said.
+        :param alteredVoice: If we want Reachy's voice to sound more
+                             robotic like.
+        :return: The rate, the number of channels and the samples of the
+                 speech.
+        """
+        if self.speechCache is not None:
+            key = self.speechCacheKey(text, alteredVoice)
+            entry = self.speechCache.get(key)
+            if entry is not None:
+                return entry
+
+        if alteredVoice:
+            data = diodeRingModulation(synthesizeVoiceToAlter(text))
+            entry = (ALTERED_VOICE_RATE, 1, data)
+        else:
+            entry = renderEngineVoice(self.engine, text)
+
+        if self.speechCache is not None:
+            self.speechCache.put(key, *entry)
+
+        return entry
+
+    def speak(self, text, alteredVoice=False, inMemory=False,
+              streaming=False):
         """Allow Reachy to speak.
 
         :param text: Text to be said.
         :param alteredVoice: If we want Reachy's voice to sound more
                              robotic like.
+        :param inMemory: If the altered voice should be synthesized, altered
+                         and played from memory instead of using intermediate
+                         audio files.
+        :param streaming: If the altered voice should be played block by
+                          block while it is being altered, such that Reachy
+                          starts to speak before the whole text is processed.
+                          Texts that are not in the cache of rendered speech
+                          are then not added to it.
         """
+        if self.speechCache is not None:
+            entry = self.speechCache.get(self.speechCacheKey(text,
+                                                             alteredVoice))
+            try:
+                # Play the speech from the cache, render it if needed
+                if entry is None and not streaming:
+                    entry = self.renderSpeech(text, alteredVoice)
+
+                if entry is not None:
+                    self.playSpeech(entry, alteredVoice)
+                    return
+            except Exception as e:
+                # The rendering of the speech failed, say it without cache
+                print("Exception: " + str(e))
+
         if not alteredVoice:
             self.engine.say(text)
             self.engine.runAndWait()
+        elif streaming:
+            # Play each altered block as soon as it is ready
+            self.reachyAudioPlayerRecorderObject.playBlocks(
+                streamAlteredVoice(text), ALTERED_VOICE_RATE)
+            time.sleep(0.5)
+        elif inMemory:
+            # Synthesize, alter and play the voice without any file
+            output = diodeRingModulation(synthesizeVoiceToAlter(text))
+            self.reachyAudioPlayerRecorderObject.playBuffer(
+                output, ALTERED_VOICE_RATE)
+            time.sleep(0.5)
         else:
             # Create an audio file containing the speech to alter
-            tts = gTTS(text)
+            tts = gtts.gTTS(text)
             tts.save('voiceToAlter.mp3')
-            sound = AudioSegment.from_mp3('voiceToAlter.mp3')
+            sound = pydub.AudioSegment.from_mp3('voiceToAlter.mp3')
             sound.export('voiceToAlter.wav', format='wav')
 
             # Alter the previously created audio file
@@ -66,6 +532,31 @@ class ReachyAudioTextToSpeech():
             self.reachyAudioPlayerRecorderObject.playAudio(outputFileName)
             time.sleep(0.5)
 
+    def playSpeech(self, entry, alteredVoice=False):
+        """Play a speech rendered by the method renderSpeech.
+
+        :param entry: The rate, the number of channels and the samples of the
+                      speech.
+        :param alteredVoice: If the voice is altered.
+        """
+        rate, channels, data = entry
+        self.reachyAudioPlayerRecorderObject.playBuffer(data, rate, channels)
+        if alteredVoice:
+            time.sleep(0.5)
+
+    async def speakAsync(self, text, alteredVoice=False, inMemory=False,
+                         streaming=False):
+        """Coroutine allowing Reachy to speak without blocking the event loop.
+
+        The speech is synthesized and played in the thread dedicated to the
+        text to speech engine. See the method speak for the parameters.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.speechExecutor,
+                                   functools.partial(self.speak, text,
+                                                     alteredVoice, inMemory,
+                                                     streaming))
+
     def availableVoices(self):
         """Display all the available voices characteristics."""
         voices = self.engine.getProperty('voices')
@@ -89,9 +580,7 @@ class ReachyAudioTextToSpeech():
         :param signalArray: The signal to be altered.
         :return: The signal altered by the diode non linearity.
         """
-        diodeArray = [0.1*(x**1.7) if x > 0 else 0.0 for x in signalArray]
-
-        return np.array(diodeArray)
+        return diode(signalArray)
 
     def diodeRingModulator(self, intputFileName):
         """Simulate a diode ring modulator electrical circuit.
@@ -106,30 +595,10 @@ class ReachyAudioTextToSpeech():
         # Read the audio file
         [_, data] = sc.read(intputFileName)
 
-        # Get maximum absolute value of input signal
-        maxVal = max(abs(data))
-
-        # Scale down the input signal
-        scaledData = data/maxVal
-
-        # Create carrier signal
-        fCarrier = 500
-        t = np.linspace(0, len(scaledData), len(scaledData))
-        carrier = np.sin(2*np.pi*fCarrier*t)
-
         # Compute output of the ring modulator circuit
-        topFirst = carrier + 0.5*scaledData
-        top = self.diode(topFirst) + self.diode(-topFirst)
-
-        bottomFirst = carrier - 0.5*scaledData
-        bottom = self.diode(bottomFirst) + self.diode(-bottomFirst)
-
-        output = top - bottom
-
-        # Scale back
-        output = 5*maxVal*output
+        output = diodeRingModulation(data)
 
         # Save the signal
-        sc.write('alteredVoice.wav', 22050, np.int16(output))
+        sc.write('alteredVoice.wav', ALTERED_VOICE_RATE, output)
 
         return 'alteredVoice.wav'
@@ -0,0 +1,130 @@
+"""Micro-benchmarks of the performance sensitive parts of the library.
+
+Run them from the root of the repository, for example :
+
+    python -m utils.benchmarks diode
+"""
+
+import sys
+import time
+import numpy as np
+
+USAGE = """Usage: python -m utils.benchmarks NAME
+        diode   time the diode non linearity used by the altered voice
+        answer  time the answering model with each inference backend
+"""
+
+
+def referenceDiode(signalArray):
+    """Original pure Python implementation of the diode model.
+
+    Kept only to be compared with the vectorized implementation.
+
+    :param signalArray: The signal to be altered.
+    :return: The signal altered by the diode non linearity.
+    """
+    diodeArray = [0.1*(x**1.7) if x > 0 else 0.0 for x in signalArray]
+
+    return np.array(diodeArray)
+
+
+def timeFunction(function, repeat=5):
+    """Return the best execution time of a function over several runs.
+
+    :param function: Function without arguments to be timed.
+    :param repeat: Number of runs.
+    :return: The best execution time in seconds.
+    """
+    best = float('inf')
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def benchmarkDiode(duration=5, rate=22050):
+    """Compare the pure Python and the vectorized diode models.
+
+    The input mimics what diodeRingModulator gives to the diode: a 500 Hz
+    carrier mixed with a scaled voice signal. As diodeRingModulator calls the
+    diode four times per utterance, the cost of the four calls is reported.
+
+    :param duration: Duration in seconds of the simulated utterance.
+    :param rate: Sample rate of the simulated utterance.
+    """
+    from reachyAudio.reachyAudioTextToSpeech import diode
+
+    rng = np.random.default_rng(0)
+    t = np.arange(duration*rate) / rate
+    signal = np.sin(2*np.pi*500*t) + 0.5*rng.uniform(-1, 1, t.size)
+
+    reference = referenceDiode(signal)
+    vectorized = diode(signal)
+    if not np.allclose(reference, vectorized):
+        print("Error: the vectorized diode differs from the reference")
+
+    for name, function in (("python", referenceDiode), ("numpy", diode)):
+        elapsed = timeFunction(lambda: [function(s) for s in (signal, -signal,
+                                                              signal, -signal)],
+                               repeat=3 if name == "python" else 20)
+        print('{:8} {:10.3f} ms per second of audio'.format(
+            name, elapsed * 1000 / duration))
+
+
+def benchmarkAnswer(repeat=5):
+    """Compare the original answering path with the inference backends.
+
+    The original path evaluates the model with autograd enabled on a tensor
+    created from a list, then scans the intents to find the responses.
+
+    :param repeat: Number of runs over all the patterns of the intents file.
+    """
+    import torch
+    from reachyAudio.reachyAudioAnswering import ReachyAudioAnswering
+
+    answering = ReachyAudioAnswering()
+    sentences = [pattern for intent in answering.data["intents"]
+                 for pattern in intent["patterns"]]
+
+    def referenceAnswer():
+        for sentence in sentences:
+            results = answering.model(
+                torch.Tensor(answering.bag_of_words(sentence)))
+            intent = answering.labels[torch.argmax(results)]
+            for tg in answering.data["intents"]:
+                if tg["tag"] == intent:
+                    break
+
+    def inferenceAnswer():
+        for sentence in sentences:
+            answering.answer(sentence)
+
+    elapsed = timeFunction(referenceAnswer, repeat)
+    print('{:12} {:10.1f} us per query'.format(
+        "original", elapsed * 1e6 / len(sentences)))
+
+    for backend in ("torch", "torchscript", "numpy"):
+        answering.prepare_inference(backend)
+        elapsed = timeFunction(inferenceAnswer, repeat)
+        print('{:12} {:10.1f} us per query'.format(
+            backend, elapsed * 1e6 / len(sentences)))
+
+
+BENCHMARKS = {
+    'diode': benchmarkDiode,
+    'answer': benchmarkAnswer,
+}
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in BENCHMARKS:
+        BENCHMARKS[sys.argv[1]]()
+    else:
+        print(USAGE)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""Pre-render all the responses of the intents file.
+
+Run it from the root of the repository before a demonstration, such that
+Reachy does not have to synthesize its answers during the conversation :
+
+    python -m utils.prerender
+
+The rendered responses are then used by ReachyAudioTextToSpeech after a call
+to its method prerenderResponses with the same parameters.
+"""
+
+import argparse
+from reachyAudio.reachyAudioTextToSpeech import prerenderResponses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--intents', default="utils/intents.json",
+                        help="JSON file containing the responses")
+    parser.add_argument('--directory', default="utils/speech_bundle",
+                        help="directory in which the responses are stored")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="number of rendering processes")
+    parser.add_argument('--rate', type=int, default=150,
+                        help="speed rate of the voice")
+    parser.add_argument('--volume', type=float, default=1.0,
+                        help="volume of the voice")
+    parser.add_argument('--voice', default="default",
+                        help="ID of the voice to be used")
+    args = parser.parse_args()
+
+    engineProperties = {'rate': args.rate,
+                        'volume': args.volume,
+                        'voice': args.voice}
+
+    prerenderResponses(engineProperties, args.intents, args.directory,
+                       args.processes)
+
+
+if __name__ == '__main__':
+    main()
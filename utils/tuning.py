@@ -7,6 +7,7 @@ detection etc...
 # -*- coding: utf-8 -*-
 
 import sys
+import json
 import struct
 import usb.core
 import usb.util
@@ -14,6 +15,8 @@ import usb.util
 USAGE = """Usage: python {} -h
         -p      show all parameters
         -r      read all parameters
+        -d FILE dump the read-write parameters in the JSON file FILE
+        -l FILE load the read-write parameters from the JSON file FILE
         NAME    get the parameter with the NAME
         NAME VALUE  set the parameter with the NAME and the VALUE
 """
@@ -66,12 +69,20 @@ PARAMETERS = {
     'DOAANGLE': (21, 0, 'int', 359, 0, 'ro', 'DOA angle. Current value. Orientation depends on build configuration.')
 }
 
+# parameters whose value changes without being written, they are always read
+# from the device (AGCGAIN is writable but is updated by the AGC)
+LIVE_PARAMETERS = set(name for name, data in PARAMETERS.items()
+                      if data[5] == 'ro') | {'AGCGAIN'}
+
 
 class Tuning:
     TIMEOUT = 100000
 
-    def __init__(self, dev):
+    def __init__(self, dev, timeout=TIMEOUT):
         self.dev = dev
+        self.timeout = timeout
+        # last values read or written of the parameters which are not live
+        self.cache = {}
 
     def write(self, name, value):
         try:
@@ -90,16 +101,40 @@ class Tuning:
         else:
             payload = struct.pack(b'ifi', data[1], float(value), 0)
 
+        # the cached value is dropped first such that it is never stale if
+        # the transfer fails
+        self.cache.pop(name, None)
+
         self.dev.ctrl_transfer(
             usb.util.CTRL_OUT | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE,
-            0, 0, id, payload, self.TIMEOUT)
+            0, 0, id, payload, self.timeout)
+
+        if name not in LIVE_PARAMETERS:
+            self.cache[name] = int(value) if data[2] == 'int' else float(value)
+
+    def write_many(self, values):
+        """
+        write several parameters, skipping the ones whose cached value is
+        already the requested one
+        """
+        for name, value in values.items():
+            data = PARAMETERS.get(name)
+            if data is not None and name in self.cache:
+                value = int(value) if data[2] == 'int' else float(value)
+                if self.cache[name] == value:
+                    continue
 
-    def read(self, name):
+            self.write(name, value)
+
+    def read(self, name, cached=True):
         try:
             data = PARAMETERS[name]
         except KeyError:
             return
 
+        if cached and name in self.cache:
+            return self.cache[name]
+
         id = data[0]
 
         cmd = 0x80 | data[1]
@@ -110,7 +145,7 @@ class Tuning:
 
         response = self.dev.ctrl_transfer(
             usb.util.CTRL_IN | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE,
-            0, cmd, id, length, self.TIMEOUT)
+            0, cmd, id, length, self.timeout)
 
         response = struct.unpack(b'ii', response.tostring())
 
@@ -119,8 +154,49 @@ class Tuning:
         else:
             result = response[0] * (2.**response[1])
 
+        if name not in LIVE_PARAMETERS:
+            self.cache[name] = result
+
         return result
 
+    def read_many(self, names, cached=True):
+        """
+        read several parameters, only the live ones and the ones which are
+        not cached yet are read from the device
+        """
+        return {name: self.read(name, cached) for name in names}
+
+    def invalidate(self, name=None):
+        """
+        forget the cached value of a parameter (of all the parameters if
+        name is None), for example after a reset of the device
+        """
+        if name is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(name, None)
+
+    def dump_profile(self, file_name):
+        """
+        save the values of all the read-write parameters in a JSON file
+        """
+        names = sorted(name for name in PARAMETERS
+                       if name not in LIVE_PARAMETERS)
+        with open(file_name, 'w') as f:
+            json.dump(self.read_many(names), f, indent=4, sort_keys=True)
+
+    def load_profile(self, file_name):
+        """
+        restore the read-write parameters saved by dump_profile
+        """
+        with open(file_name) as f:
+            values = json.load(f)
+
+        # only the parameters whose cached value differs from the profile
+        # are written, the others are written without being read first
+        self.write_many({name: value for name, value in values.items()
+                         if name not in LIVE_PARAMETERS})
+
     def set_vad_threshold(self, db):
         self.write('GAMMAVAD_SR', db)
 
@@ -135,7 +211,7 @@ class Tuning:
     def version(self):
         return self.dev.ctrl_transfer(
             usb.util.CTRL_IN | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE,
-            0, 0x80, 0, 1, self.TIMEOUT)[0]
+            0, 0x80, 0, 1, self.timeout)[0]
 
     def close(self):
         """
@@ -183,15 +259,21 @@ def main():
             if sys.argv[1] == '-r':
                 print('{:24} {}'.format('name', 'value'))
                 print('-------------------------------')
-                for name in sorted(PARAMETERS.keys()):
-                    print('{:24} {}'.format(name, dev.read(name)))
+                values = dev.read_many(sorted(PARAMETERS.keys()))
+                for name, value in values.items():
+                    print('{:24} {}'.format(name, value))
+            elif sys.argv[1] in ('-d', '-l') and len(sys.argv) > 2:
+                if sys.argv[1] == '-d':
+                    dev.dump_profile(sys.argv[2])
+                else:
+                    dev.load_profile(sys.argv[2])
             else:
                 name = sys.argv[1].upper()
                 if name in PARAMETERS:
                     if len(sys.argv) > 2:
                         dev.write(name, sys.argv[2])
                     
-                    print('{}: {}'.format(name, dev.read(name)))
+                    print('{}: {}'.format(name, dev.read(name, cached=False)))
                 else:
                     print('{} is not a valid name'.format(name))
 